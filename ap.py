@@ -2,32 +2,47 @@
 
 
 
-from flask import Flask, render_template_string, request, Response, url_for
+from flask import Flask, render_template_string, request, Response, url_for, g
 import pandas as pd
+import numpy as np
 import folium
 from folium.plugins import MarkerCluster, FastMarkerCluster 
 import ee
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # Use non-GUI backend to avoid errors
-import matplotlib.pyplot as plt
-from PIL import Image
-import geemap
+import requests
 import io
 import os
+import re
+import sys
+import zlib
+import fcntl
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+import shared_store
 
 app = Flask(__name__)
 
+# Allow ?profile=1 on any request (off by default so it can't be abused in production)
+PROFILING_ENABLED = os.getenv("ENABLE_PROFILING", "0") == "1"
+
 # Initialize Google Earth Engine (GEE)
 SERVICE_ACCOUNT_PATH = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'proven-space-452610-g1-beef75df7b84.json')
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = SERVICE_ACCOUNT_PATH
 
-try:
-    credentials = ee.ServiceAccountCredentials(None, SERVICE_ACCOUNT_PATH)
-    ee.Initialize(credentials)
-    print("✅ Google Earth Engine authenticated successfully!")
-except Exception as e:
-    print(f"❌ Error initializing Google Earth Engine: {e}")
+def init_earth_engine():
+    try:
+        credentials = ee.ServiceAccountCredentials(None, SERVICE_ACCOUNT_PATH)
+        ee.Initialize(credentials)
+        print(f"✅ Google Earth Engine authenticated successfully! (pid {os.getpid()})")
+    except Exception as e:
+        print(f"❌ Error initializing Google Earth Engine: {e}")
+
+# Under gunicorn with preload_app the master sets DEFER_EE_INIT=1 and every
+# worker calls init_earth_engine() after fork (see gunicorn.conf.py), so the
+# EE HTTP session is never shared between processes.
+if os.getenv("DEFER_EE_INIT", "0") != "1":
+    init_earth_engine()
 
 # Backend: CSV Files (For Map Markers)
 csv_files = {
@@ -38,6 +53,53 @@ csv_files = {
 }
 
 
+# Inventories added through /ingest or ingest.py: one append-only CSV per country
+INVENTORY_DIR = os.path.join("data", "inventory")
+_inventory_offsets = {}  # path -> bytes already loaded into df
+_dataset_lock = threading.RLock()
+
+
+def inventory_path(country):
+    return os.path.join(INVENTORY_DIR, f"{country}.csv")
+
+
+# Country names become file names, so keep them to letters, digits, spaces, dots, dashes and apostrophes
+def validate_country(country):
+    country = (country or "").strip()
+    if not re.fullmatch(r"[^\W_][\w .'-]{0,63}", country):
+        raise ValueError(f"Invalid country name: {country!r}")
+    return country
+
+
+# Rows appended to the inventory files since they were last read (only whole lines)
+def read_new_inventory_rows():
+    frames = []
+    if not os.path.isdir(INVENTORY_DIR):
+        return frames
+
+    for name in sorted(os.listdir(INVENTORY_DIR)):
+        if not name.endswith(".csv"):
+            continue
+        path = os.path.join(INVENTORY_DIR, name)
+        offset = _inventory_offsets.get(path, 0)
+        if os.path.getsize(path) <= offset:
+            continue
+
+        with open(path, "rb") as file:
+            header = file.readline()
+            file.seek(max(offset, len(header)))
+            data = file.read()
+        end = data.rfind(b"\n") + 1  # A writer may be half-way through a line
+        if end == 0:
+            continue
+
+        rows = pd.read_csv(io.BytesIO(header + data[:end]))
+        rows["country"] = name[:-len(".csv")]
+        frames.append(rows)
+        _inventory_offsets[path] = max(offset, len(header)) + end
+    return frames
+
+
 # Load CSV Data for Map
 def load_data():
     dataframes = []
@@ -45,23 +107,176 @@ def load_data():
         df = pd.read_csv(path)
         df["country"] = country
         dataframes.append(df)
+    dataframes.extend(read_new_inventory_rows())
     return pd.concat(dataframes, ignore_index=True)
 
 df = load_data()
 df = df.dropna(subset=["LATITUD", "LONGITUD"])  # Remove NaN values
 
+# Pest scores written by score_points.py, joined onto df by coordinates
+PEST_SCORES_PATH = os.path.join("data", "pest_scores.csv")
+PEST_SCORE_COLUMNS = ["diseased_area", "healthy_area", "pest_status"]
+_pest_scores_mtime = None
+_pest_scores = None  # Last pest_scores.csv that parsed: LATITUD, LONGITUD + PEST_SCORE_COLUMNS
+
+
+# (Re)read pest_scores.csv. A file that doesn't parse (e.g. hand-edited or
+# truncated) is logged and skipped, keeping the scores from the last good read;
+# it's retried once score_points.py writes to it again.
+def load_pest_scores():
+    global _pest_scores, _pest_scores_mtime
+    _pest_scores_mtime = os.path.getmtime(PEST_SCORES_PATH)
+    try:
+        scores = pd.read_csv(PEST_SCORES_PATH, dtype={"params": str})
+        # Only default-parameter scores colour the map; score_points.py --param runs are experiments
+        if "params" in scores.columns:
+            scores = scores[scores["params"].fillna("{}") == "{}"]
+        # Keep the most recent score per point if several date windows were scored
+        scores = scores.sort_values("scored_at").drop_duplicates(["LATITUD", "LONGITUD"], keep="last")
+        _pest_scores = scores[["LATITUD", "LONGITUD"] + PEST_SCORE_COLUMNS]
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Could not read {PEST_SCORES_PATH}, keeping the previous scores: {e}")
+
+
+def attach_pest_scores(points):
+    points = points.drop(columns=[col for col in PEST_SCORE_COLUMNS if col in points.columns])
+
+    exists = os.path.exists(PEST_SCORES_PATH)
+    if exists and os.path.getmtime(PEST_SCORES_PATH) != _pest_scores_mtime:
+        load_pest_scores()
+    if not exists or _pest_scores is None:  # No scores file, or no good read of it yet
+        for col in PEST_SCORE_COLUMNS:
+            points[col] = None
+        return points
+    return points.merge(_pest_scores, on=["LATITUD", "LONGITUD"], how="left")
+
+
+# Pick up new scores while score_points.py is running, without a restart
+def refresh_pest_scores():
+    global df
+    if os.path.exists(PEST_SCORES_PATH) and os.path.getmtime(PEST_SCORES_PATH) != _pest_scores_mtime:
+        df = attach_pest_scores(df)
+
+
+# Identify the correct column name for product type
+def find_product_column(points):
+    possible_product_columns = ["PRODUCTO/CULTIVO", "Producto", "PRODUCTO"]
+    return next((col for col in possible_product_columns if col in points.columns), None)
+
+
+# Read-only country / product codes in memory-mapped files, shared zero-copy by every worker.
+# They back the unfiltered country/product counts; everything else still reads
+# df, which each worker rebuilds for itself on refresh_dataset/refresh_pest_scores.
+def publish_point_store():
+    global point_store
+    try:
+        shared_store.publish_points(df, find_product_column(df))
+        point_store = shared_store.PointStore()
+    except Exception as e:
+        print(f"⚠️ Shared point store unavailable, using the in-process dataframe: {e}")
+        point_store = None
+
+
+point_store = None
+publish_point_store()
+
+
+# Product column new inventory rows are written with (the one the charts use)
+def inventory_product_column():
+    return find_product_column(df) or "PRODUCTO"
+
+
+# Pick up inventory rows ingested by any process (and new pest scores), without a restart
+def refresh_dataset():
+    global df
+    with _dataset_lock:
+        frames = read_new_inventory_rows()
+        if frames:
+            new_rows = pd.concat(frames, ignore_index=True).dropna(subset=["LATITUD", "LONGITUD"])
+            df = pd.concat([df, attach_pest_scores(new_rows)], ignore_index=True)
+            publish_point_store()
+        refresh_pest_scores()
+
+
+# Opens one country's inventory for a whole ingest and yields
+# append_points(rows, country) -> (added, duplicates), which skips coordinates
+# already in the dataset or in earlier chunks. The file stays flocked (one
+# writer per inventory across processes) and df is refreshed once before
+# and once after, not per chunk.
+@contextmanager
+def inventory_appender(country):
+    os.makedirs(INVENTORY_DIR, exist_ok=True)
+    path = inventory_path(country)
+
+    try:
+        with open(path, "a", newline="", encoding="utf-8") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                refresh_dataset()  # Dedupe against rows other workers already added too
+                existing = set(zip(df["LATITUD"].round(6), df["LONGITUD"].round(6)))
+                columns = pd.read_csv(path, nrows=0).columns if os.path.getsize(path) else None
+
+                def append_points(rows, _country):
+                    nonlocal columns
+                    keys = pd.Series(list(zip(rows["LATITUD"].round(6), rows["LONGITUD"].round(6))), index=rows.index)
+                    new_rows = rows[~keys.isin(existing) & ~keys.duplicated()]
+                    if len(new_rows):
+                        if columns is None:
+                            new_rows.to_csv(file, index=False)
+                            columns = new_rows.columns
+                        else:
+                            new_rows.reindex(columns=columns).to_csv(file, index=False, header=False)
+                        file.flush()
+                        existing.update(keys[new_rows.index])
+                    return len(new_rows), len(rows) - len(new_rows)
+
+                yield append_points
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+    finally:
+        refresh_dataset()  # Also after a partial ingest: earlier chunks were written
+
+
+# Rows of df matching a pest status filter ("Healthy", "Moderate", "Diseased", "Unscored")
+def filter_points(status=None):
+    if not status:
+        return df
+    if status == "Unscored":
+        return df[df["pest_status"].isnull()]
+    return df[df["pest_status"] == status]
+
+
+df = attach_pest_scores(df)
+
+# Define unique colors for each country
+country_colors = {
+    "Colombia": "blue",
+    "Peru": "red",
+    "Ecuador": "green",
+    "Bolivia": "pink"
+}
+
+# Colors handed out (by name hash) to countries added through ingestion
+extra_country_colors = ["purple", "orange", "darkblue", "cadetblue", "darkgreen", "darkred", "beige", "black"]
+
+
+def country_color(country):
+    if country in country_colors:
+        return country_colors[country]
+    return extra_country_colors[zlib.crc32(country.encode("utf-8")) % len(extra_country_colors)]
+
+
 # Function to create the Folium map
-def create_map():
+# color_by is "country" or "health"; status limits the markers to one pest status
+def create_map(color_by="country", status=None):
+    with metrics.timed("create_map"):
+        return _build_map(filter_points(status), color_by)
+
+
+def _build_map(points, color_by):
     # Create base map
     m = folium.Map(location=[-10, -70], zoom_start=4)
 
-    # Define unique colors for each country
-    country_colors = {
-        "Colombia": "blue",
-        "Peru": "red",
-        "Ecuador": "green",
-        "Bolivia": "pink"
-    }
 
     # Load GeoJSON file for country boundaries
     geojson_path = "countries.geojson"
@@ -70,48 +285,109 @@ def create_map():
         with open(geojson_path, "r", encoding="utf-8") as file:
             geojson_data = json.load(file)
 
-        selected_countries = ["Colombia", "Peru", "Ecuador", "Bolivia"]
+        selected_countries = set(df["country"].unique())
         geojson_data["features"] = [
             feature for feature in geojson_data["features"]
             if feature["properties"].get("name") in selected_countries
         ]
 
-        folium.GeoJson(
-            geojson_data,
-            name="Country Boundaries",
-            style_function=lambda x: {
-                "fillColor": "yellow",
-                "color": "black",
-                "weight": 2,
-                "fillOpacity": 0.3
-            }
-        ).add_to(m)
+        with metrics.timed("create_map.geojson"):
+            folium.GeoJson(
+                geojson_data,
+                name="Country Boundaries",
+                style_function=lambda x: {
+                    "fillColor": "yellow",
+                    "color": "black",
+                    "weight": 2,
+                    "fillOpacity": 0.3
+                }
+            ).add_to(m)
 
     except Exception as e:
         print(f"Error loading GeoJSON: {e}")
 
-    # ✅ Use different colors per country
-    for _, row in df.iterrows():
-        country = row["country"]
-        color = country_colors.get(country, "gray")  # Default to gray if country not found
-
-        folium.CircleMarker(
-            location=[row["LATITUD"], row["LONGITUD"]],
-            radius=3,
-            color=color,
-            fill=True,
-            fill_color=color,
-            fill_opacity=0.7,
-            popup=folium.Popup(f"""
-                <b>{country}</b><br>
-                Lat: {row["LATITUD"]}<br>Long: {row["LONGITUD"]}<br>
-                <button onclick="window.parent.fillCoordinates({row["LATITUD"]}, {row["LONGITUD"]})">
-                    Select
-                </button>
-            """, max_width=250),
+    # Precomputed NDVI / pest tile layers (see precompute_tiles.py)
+    with metrics.timed("create_map.tile_layers"):
+        add_precomputed_tile_layers(m)
+
+    # Marker colors by pest status (same colors as the pest chart)
+    health_colors = {
+        "Healthy": "green",
+        "Moderate": "yellow",
+        "Diseased": "red"
+    }
+
+    # ✅ Use different colors per country (or per pest status)
+    with metrics.timed("create_map.markers"):
+        for _, row in points.iterrows():
+            country = row["country"]
+            pest_status = row["pest_status"] if pd.notnull(row["pest_status"]) else None
+            if color_by == "health":
+                color = health_colors.get(pest_status, "gray")  # Gray for points not scored yet
+            else:
+                color = country_color(country)
+            health_line = (f"Health: {pest_status} ({row['diseased_area']}% diseased)<br>"
+                           if pest_status else "")
+
+            folium.CircleMarker(
+                location=[row["LATITUD"], row["LONGITUD"]],
+                radius=3,
+                color=color,
+                fill=True,
+                fill_color=color,
+                fill_opacity=0.7,
+                popup=folium.Popup(f"""
+                    <b>{country}</b><br>
+                    Lat: {row["LATITUD"]}<br>Long: {row["LONGITUD"]}<br>
+                    {health_line}
+                    <button onclick="window.parent.fillCoordinates({row["LATITUD"]}, {row["LONGITUD"]})">
+                        Select
+                    </button>
+                """, max_width=250),
+            ).add_to(m)
+
+    with metrics.timed("create_map.render"):
+        return m._repr_html_()
+
+
+TILES_INDEX_PATH = os.path.join("static", "tiles", "index.json")
+
+
+# Overlay the latest precomputed window of each tile layer per country
+def add_precomputed_tile_layers(m):
+    if not os.path.exists(TILES_INDEX_PATH):
+        return
+
+    try:
+        import json
+        with open(TILES_INDEX_PATH, "r", encoding="utf-8") as file:
+            layers = json.load(file)["layers"]
+    except Exception as e:
+        print(f"Error loading tile index: {e}")
+        return
+
+    latest = {}
+    for layer in layers:
+        key = (layer["layer"], layer["country"])
+        if key not in latest or layer["end_date"] > latest[key]["end_date"]:
+            latest[key] = layer
+
+    layer_titles = {"ndvi": "NDVI", "pest": "Pest density"}
+    for (layer_name, country), layer in sorted(latest.items()):
+        folium.raster_layers.TileLayer(
+            tiles=layer["url"],
+            name=f"{layer_titles.get(layer_name, layer_name)} – {country} ({layer['start_date']} to {layer['end_date']})",
+            attr="Sentinel-2 NDVI (precomputed)",
+            overlay=True,
+            control=True,
+            show=False,
+            min_zoom=layer["min_zoom"],
+            max_native_zoom=layer["max_zoom"],
+            max_zoom=18,
         ).add_to(m)
 
-    return m._repr_html_()
+    if latest:
+        folium.LayerControl(collapsed=True).add_to(m)
 
 
 
@@ -120,113 +396,303 @@ def create_map():
 import cv2
 import os
 import json
+import hmac
+from collections import OrderedDict
+import http_cache
+import export
+import ingest
+import ndvi_analysis
 
 # Global dictionary to store pest density data
 pest_data_dict = {}
 
+# Cross-worker cache (mmap'd file) for NDVI images and pest data; opened lazily in each process
+SHARED_CACHE_PATH = os.path.join(shared_store.SHARED_CACHE_DIR, "ndvi_cache.bin")
+SHARED_CACHE_SLOTS = int(os.getenv("SHARED_CACHE_SLOTS", "512"))
+SHARED_CACHE_SLOT_SIZE = int(os.getenv("SHARED_CACHE_SLOT_SIZE", str(512 * 1024)))
+_shared_cache = None
+_shared_cache_pid = None
+
+
+def get_shared_cache():
+    global _shared_cache, _shared_cache_pid
+    if _shared_cache_pid != os.getpid():
+        _shared_cache_pid = os.getpid()
+        try:
+            _shared_cache = shared_store.SlotCache(SHARED_CACHE_PATH, SHARED_CACHE_SLOTS, SHARED_CACHE_SLOT_SIZE)
+        except Exception as e:
+            print(f"⚠️ Shared cache unavailable: {e}")
+            _shared_cache = None
+    return _shared_cache
+
+
+# The latest analysis per point, stored with the date window and parameters it was run with
+def remember_pest_data(lat, lon, pest_data, start_date, end_date, params):
+    record = {**pest_data, "start_date": start_date, "end_date": end_date, "params": params}
+    pest_data_dict[f"{lat},{lon}"] = record
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.put_json(("pest", lat, lon), record)
+
+
+# Pest data for a point computed by this or any other worker. With a window
+# and params, entries from a different analysis are treated as missing.
+def lookup_pest_data(lat, lon, start_date=None, end_date=None, params=None):
+    pest_data = pest_data_dict.get(f"{lat},{lon}")
+    if pest_data is None:
+        shared_cache = get_shared_cache()
+        if shared_cache is not None:
+            pest_data = shared_cache.get_json(("pest", lat, lon))
+    if pest_data is not None and start_date is not None and (
+            pest_data.get("start_date") != start_date or pest_data.get("end_date") != end_date
+            or pest_data.get("params") != params):
+        return None
+    return pest_data
+
 # Ensure the directory for storing pest images exists
 os.makedirs("static/pest_images", exist_ok=True)
 
-def generate_ndvi_plot(lat, lon, start_date="2021-01-01", end_date="2021-12-31"):
-    try:
-        point = ee.Geometry.Point(lon, lat)
-
-        # Fetch Sentinel-2 imagery
-        data = ee.ImageCollection("COPERNICUS/S2").filterBounds(point)
-        image = ee.Image(data.filterDate(start_date, end_date).sort("CLOUD_COVERAGE_ASSESSMENT").first())
-
-        # NDVI Calculation
-        NDVI = image.expression(
-            "(NIR - RED) / (NIR + RED)",
-            {
-                'NIR': image.select("B8"),
-                'RED': image.select("B4")
-            }
-        )
+# Date range used when none is given (e.g. empty date inputs)
+DEFAULT_START_DATE = "2021-01-01"
+DEFAULT_END_DATE = "2021-12-31"
+
+# Identifies one downloaded NDVI raster: (lat, lon, start_date, end_date, buffer, scale)
+def raster_key(lat, lon, start_date, end_date, params=None):
+    params = params or ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    return (lat, lon, start_date, end_date, params["buffer"], params["scale"])
+
+
+# Non-default raster parameters, for URLs that must pin the raster
+def raster_query(params):
+    return {name: params[name] for name in ndvi_analysis.RASTER_PARAMS
+            if params[name] != ndvi_analysis.DEFAULT_ANALYSIS_PARAMS[name]}
+
+
+# Cache for rendered NDVI plots, raw NDVI arrays and pest images. The shared
+# cache is the only tier when it's available, so a worker holds nothing
+# beyond the request it's serving; the small per-process LRU only keeps
+# entries that can't go there (no shared cache, or too big for a slot).
+class LayeredCache:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def shared_key(self, key):
+        return (self.name,) + tuple(key)
+
+    def get(self, key, decode):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+        shared_cache = get_shared_cache()
+        data = shared_cache.get(self.shared_key(key)) if shared_cache is not None else None
+        if data is None:
+            return None
+        metrics.cache_hit(f"{self.name}_shared")
+        return decode(data)
+
+    def put(self, key, entry, data):
+        shared_cache = get_shared_cache()
+        if shared_cache is not None and shared_cache.put(self.shared_key(key), data):
+            return entry
+        return self.store(key, entry)
+
+    def store(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+# Encoded webp/avif variants of an image entry, kept in the shared cache next
+# to the PNG so no worker encodes the same variant twice (dict interface, as
+# used by http_cache.image_response_parts)
+class SharedVariants(dict):
+    def __init__(self, shared_key):
+        super().__init__()
+        self.shared_key = shared_key
+
+    def get(self, fmt, default=None):
+        value = super().get(fmt)
+        if value is None:
+            shared_cache = get_shared_cache()
+            value = shared_cache.get(self.shared_key + (fmt,)) if shared_cache is not None else None
+            if value is not None:
+                super().__setitem__(fmt, value)
+        return default if value is None else value
+
+    def __contains__(self, fmt):
+        return self.get(fmt) is not None
+
+    def __getitem__(self, fmt):
+        value = self.get(fmt)
+        if value is None:
+            raise KeyError(fmt)
+        return value
+
+    def __setitem__(self, fmt, value):
+        super().__setitem__(fmt, value)
+        shared_cache = get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.put(self.shared_key + (fmt,), value)
+
+
+# Per-process fallback sizes (entries only land here without a usable shared cache)
+NDVI_IMAGE_CACHE_SIZE = int(os.getenv("NDVI_IMAGE_CACHE_SIZE", "16"))
+ndvi_image_cache = LayeredCache("ndvi_png", NDVI_IMAGE_CACHE_SIZE)
+
+# Raw NDVI arrays, so changing analysis thresholds skips Earth Engine entirely
+NDVI_ARRAY_CACHE_SIZE = int(os.getenv("NDVI_ARRAY_CACHE_SIZE", "16"))
+ndvi_array_cache = LayeredCache("ndvi_raw", NDVI_ARRAY_CACHE_SIZE)
 
-        # Scale NDVI for visualization
-        NDVI_scaled = NDVI.multiply(255).toByte()
 
-        # Clip NDVI around the selected point
-        region = point.buffer(1000).bounds()
-        url = NDVI_scaled.clip(region).getDownloadURL({
-            'scale': 10,
-            'region': region,
-            'format': 'GeoTIFF'
-        })
+# Cache entries hold the PNG, its content hash (the ETag) and lazily encoded
+# webp/avif variants (shared between workers when the entry has a shared key)
+def _image_entry(png_bytes, shared_key=None):
+    variants = SharedVariants(("variant",) + shared_key) if shared_key is not None else {}
+    return {"png": png_bytes, "etag": http_cache.content_etag(png_bytes), "variants": variants}
 
-        # Download NDVI image and convert to NumPy array
+
+def ndvi_cache_get(key):
+    return ndvi_image_cache.get(key, lambda png: _image_entry(png, ndvi_image_cache.shared_key(key)))
+
+
+def ndvi_cache_put(key, png_bytes):
+    return ndvi_image_cache.put(key, _image_entry(png_bytes, ndvi_image_cache.shared_key(key)), png_bytes)
+
+
+def _array_to_bytes(image_np):
+    out = io.BytesIO()
+    np.save(out, image_np, allow_pickle=False)
+    return out.getvalue()
+
+
+def _array_from_bytes(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def ndvi_array_get(key):
+    return ndvi_array_cache.get(key, _array_from_bytes)
+
+
+def ndvi_array_put(key, image_np):
+    return ndvi_array_cache.put(key, image_np, _array_to_bytes(image_np))
+
+
+# NDVI raster for a point as a uint8 array, from cache or Earth Engine
+def fetch_ndvi_array(lat, lon, start_date, end_date, params=None):
+    params = params or ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    key = raster_key(lat, lon, start_date, end_date, params)
+    image_np = ndvi_array_get(key)
+    if image_np is not None:
+        metrics.cache_hit("ndvi_array")
+        return image_np
+    metrics.cache_miss("ndvi_array")
+
+    with metrics.timed("ndvi.ee_query"):
+        url = ndvi_download_url(lat, lon, start_date, end_date, params["buffer"], params["scale"])
+
+    # Download NDVI image and convert to NumPy array
+    with metrics.timed("ndvi.download"):
+        image_np = ndvi_analysis.decode_ndvi_geotiff(download_ndvi_bytes(url))
+    return ndvi_array_put(key, image_np)
+
+
+# params: analysis parameters from ndvi_analysis.analysis_params() (defaults if None)
+def generate_ndvi_plot(lat, lon, start_date=DEFAULT_START_DATE, end_date=DEFAULT_END_DATE, params=None):
+    with metrics.in_flight("ndvi"), metrics.timed("ndvi.total"):
+        return _generate_ndvi_plot(lat, lon, start_date, end_date, params or ndvi_analysis.analysis_params())
+
+
+def _generate_ndvi_plot(lat, lon, start_date, end_date, params):
+    try:
         try:
-            image_pil = Image.open(geemap.download_file(url)).convert("L")  # Convert to grayscale
-            image_np = np.array(image_pil)
+            image_np = fetch_ndvi_array(lat, lon, start_date, end_date, params)
         except Exception as e:
             print(f"⚠️ NDVI Image Download Failed: {e}")
             return None, None, None
 
-        if image_np is None or image_np.size == 0:
-            raise ValueError("NDVI image could not be processed.")
-
         # ---------------------- NDVI VISUALIZATION ---------------------- #
-        fig, ax = plt.subplots(figsize=(6, 5))
-        img_plot = ax.imshow(image_np, cmap='RdYlGn')  # Red-Yellow-Green colormap
-        cbar = plt.colorbar(img_plot, ax=ax)
-        cbar.set_label("NDVI Value")
-        ax.axis("off")
-        ax.set_title(f"NDVI at Lat: {lat}, Lon: {lon}")
-
-        # Convert Matplotlib figure to in-memory image
-        img_bytes = io.BytesIO()
-        plt.savefig(img_bytes, format="png", bbox_inches="tight")
-        plt.close(fig)
-        img_bytes.seek(0)
+        # The plot only depends on the raster, so threshold changes reuse it
+        key = raster_key(lat, lon, start_date, end_date, params)
+        entry = ndvi_cache_get(key)
+        if entry is None:
+            with metrics.timed("ndvi.matplotlib"):
+                entry = ndvi_cache_put(key, ndvi_analysis.render_ndvi_png(image_np, lat, lon).getvalue())
+        img_bytes = io.BytesIO(entry["png"])
 
         # ---------------------- PEST DETECTION ---------------------- #
-        # Apply Canny Edge Detection
-        edges = cv2.Canny(image_np, threshold1=50, threshold2=150)
-
-        # Apply Laplacian (Delight Filter)
-        laplacian = cv2.Laplacian(image_np, cv2.CV_64F)
-        laplacian = np.uint8(np.absolute(laplacian))
-
-        # Combine Edge Detection & Laplacian for Pest Detection
-        pest_detection = cv2.addWeighted(edges, 0.7, laplacian, 0.3, 0)
-
-        # Calculate Pest Affected Percentage
-        total_pixels = pest_detection.size
-        diseased_pixels = np.sum(pest_detection > 100)
-        pest_density = (diseased_pixels / total_pixels) * 100
-        healthy_area = 100 - pest_density
-
-        # Categorize Pest Infection
-        if pest_density < 10:
-            status = "Healthy"
-            color = "green"
-        elif pest_density < 30:
-            status = "Moderate"
-            color = "yellow"
-        else:
-            status = "Diseased"
-            color = "red"
+        with metrics.timed("ndvi.opencv"):
+            pest_detection, pest_density = ndvi_analysis.detect_pests(image_np, params)
 
         # Save Pest Detection Image
-        pest_image_path = f"static/pest_images/pest_{lat}_{lon}.png"
-        cv2.imwrite(pest_image_path, pest_detection)
+        pest_image_path = pest_image_path_for(lat, lon)
+        with metrics.timed("ndvi.save_pest_image"):
+            cv2.imwrite(pest_image_path, pest_detection)
 
         # Store Pest Data for Visualization (Unique for each coordinate)
-        pest_data_dict[f"{lat},{lon}"] = {
-            "lat": lat, "lon": lon,
-            "diseased_area": round(pest_density, 2),
-            "healthy_area": round(healthy_area, 2),
-            "color": color
-        }
+        pest_data = ndvi_analysis.pest_summary(lat, lon, pest_density, params)
+        remember_pest_data(lat, lon, pest_data, start_date, end_date, params)
 
-        return img_bytes, pest_image_path, pest_data_dict[f"{lat},{lon}"]
+        return img_bytes, pest_image_path, pest_data
 
     except Exception as e:
         print(f"❌ Error in NDVI & Pest Detection Calculation: {e}")
         return None, None, None
 
 
+NDVI_DOWNLOAD_TIMEOUT = float(os.getenv("NDVI_DOWNLOAD_TIMEOUT", "60"))
+
+
+# Download the NDVI GeoTIFF into memory. geemap.download_file saves it to a
+# file named after the URL, which concurrent requests would overwrite.
+def download_ndvi_bytes(url):
+    response = requests.get(url, timeout=NDVI_DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def pest_image_path_for(lat, lon):
+    return f"static/pest_images/pest_{lat}_{lon}.png"
+
+
+# Earth Engine part of the NDVI lookup: build the least-cloudy Sentinel-2
+# NDVI for a box of `buffer` metres around the point and return its GeoTIFF download URL
+def ndvi_download_url(lat, lon, start_date, end_date, buffer=1000, scale=10):
+    point = ee.Geometry.Point(lon, lat)
+
+    # Fetch Sentinel-2 imagery
+    data = ee.ImageCollection("COPERNICUS/S2").filterBounds(point)
+    image = ee.Image(data.filterDate(start_date, end_date).sort("CLOUD_COVERAGE_ASSESSMENT").first())
+
+    # NDVI Calculation
+    NDVI = image.expression(
+        "(NIR - RED) / (NIR + RED)",
+        {
+            'NIR': image.select("B8"),
+            'RED': image.select("B4")
+        }
+    )
+
+    # Scale NDVI for visualization
+    NDVI_scaled = NDVI.multiply(255).toByte()
+
+    # Clip NDVI around the selected point
+    region = point.buffer(buffer).bounds()
+    return NDVI_scaled.clip(region).getDownloadURL({
+        'scale': scale,
+        'region': region,
+        'format': 'GeoTIFF'
+    })
+
+
 
 
 
@@ -240,43 +706,88 @@ def index():
     pest_image_path = None
     pest_data = None  # Store current pest data
 
+    # Map filter / colouring (query string, or hidden fields on the NDVI form)
+    status_filter = request.values.get("status") or None
+    color_by = request.values.get("color_by", "country")
+
+    # Optional analysis parameters (buffer, scale, canny_low, ...) posted with the form
+    params = ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+
     if request.method == "POST":
         try:
             lat = float(request.form["latitude"])
             lon = float(request.form["longitude"])
+            params = ndvi_analysis.analysis_params(request.form)
             ndvi_available = True
-            start_date = request.form["start_date"]
-            end_date = request.form["end_date"]
-            _, pest_image_path, pest_data = generate_ndvi_plot(lat, lon, start_date, end_date)
+            start_date = request.form["start_date"] or DEFAULT_START_DATE
+            end_date = request.form["end_date"] or DEFAULT_END_DATE
+            with metrics.timed("index.ndvi"):
+                _, pest_image_path, pest_data = generate_ndvi_plot(lat, lon, start_date, end_date, params)
 
         except ValueError:
             pass  # Ignore invalid input
 
-    map_html = create_map()
+    refresh_dataset()
+    map_html = create_map(color_by, status_filter)
 
-    # Count data points per country
-    country_counts = df["country"].value_counts().to_dict()
+    with metrics.timed("index.stats"):
+        country_data_json, product_data_json = _dashboard_stats_json(filter_points(status_filter))
+
+    # Pass only the current pest detection data
+    pest_data_json = json.dumps([pest_data]) if pest_data else "[]"
+
+    with metrics.timed("index.render"):
+        return _render_dashboard(map_html, ndvi_available, lat, lon, start_date, end_date, country_data_json,
+                                 product_data_json, pest_data_json, pest_image_path,
+                                 status_filter, color_by, raster_query(params))
 
-    # Identify the correct column name for product type
-    possible_product_columns = ["PRODUCTO/CULTIVO", "Producto", "PRODUCTO"]
-    product_column = next((col for col in possible_product_columns if col in df.columns), None)
 
-    # Count data points per product type
-    if product_column and not df[product_column].isnull().all():
-        product_counts = df[product_column].value_counts().to_dict()
+# Count data points per country and product type for the D3.js charts
+def _dashboard_stats_json(points):
+    product_column = find_product_column(points)
+
+    # Unfiltered view: count straight from the shared point arrays
+    if points is df and point_store is not None and point_store.index["rows"] == len(df):
+        country_counts = point_store.country_counts()
+        product_counts = point_store.product_counts()
     else:
+        # Count data points per country
+        country_counts = points["country"].value_counts().to_dict()
+
+        # Count data points per product type
+        product_counts = (points[product_column].value_counts().to_dict()
+                          if product_column else {})
+
+    if not product_counts:
         product_counts = {"No Data": 1}  # Avoid empty dataset issue
 
     # Convert data to JSON for D3.js visualization
-    import json
     country_data_json = json.dumps([{"country": k, "count": v} for k, v in country_counts.items()])
     product_data_json = json.dumps([{"product": k, "count": v} for k, v in product_counts.items()])
-    
-    # Pass only the current pest detection data
-    pest_data_json = json.dumps([pest_data]) if pest_data else "[]"
+    return country_data_json, product_data_json
 
 
-    return render_template_string('''
+def _render_dashboard(map_html, ndvi_available, lat, lon, start_date, end_date, country_data_json,
+                      product_data_json, pest_data_json, pest_image_path,
+                      status_filter=None, color_by="country", raster_params=None):
+    # The date range (and any non-default raster parameters) are part of the
+    # URL so the image can be cached as immutable
+    ndvi_image_url = (url_for('get_ndvi_image', lat=lat, lon=lon, start_date=start_date, end_date=end_date,
+                              **(raster_params or {}))
+                      if ndvi_available else None)
+    return render_template_string(DASHBOARD_TEMPLATE, map_html=map_html, ndvi_available=ndvi_available,
+                                  ndvi_image_url=ndvi_image_url, country_data_json=country_data_json,
+                                  product_data_json=product_data_json, pest_data_json=pest_data_json,
+                                  pest_image_path=pest_image_path, status_filter=status_filter,
+                                  color_by=color_by, pest_statuses=PEST_STATUSES)
+
+
+# Options for the map's pest status filter
+PEST_STATUSES = ["Healthy", "Moderate", "Diseased", "Unscored"]
+
+
+# Dashboard page (shared by the Flask app and asgi_app.py)
+DASHBOARD_TEMPLATE = '''
     <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -353,6 +864,20 @@ def index():
             width: 150px;
         }
 
+        .top-input-section select {
+            padding: 10px;
+            border: none;
+            border-radius: 6px;
+            outline: none;
+            font-size: 14px;
+            background: transparent;
+            color: white;
+        }
+
+        .top-input-section select option {
+            color: #252525;
+        }
+
         .top-input-section button {
             background: #ff9800;
             color: white;
@@ -493,8 +1018,28 @@ def index():
                     <label for="longitude">Longitude:</label>
                     <input type="text" id="longitude" name="longitude" placeholder="Longitude will auto-fill" readonly>
                 </div>
+                <input type="hidden" name="status" value="{{ status_filter or '' }}">
+                <input type="hidden" name="color_by" value="{{ color_by }}">
                 <button type="submit">🌿 CLEAR </button>
             </form>
+            <form method="GET" id="filter-form" style="margin-left: 15px;">
+                <div class="input-group">
+                    <label for="status-filter">Health:</label>
+                    <select id="status-filter" name="status" onchange="this.form.submit()">
+                        <option value="">All</option>
+                        {% for status in pest_statuses %}
+                        <option value="{{ status }}" {% if status == status_filter %}selected{% endif %}>{{ status }}</option>
+                        {% endfor %}
+                    </select>
+                </div>
+                <div class="input-group">
+                    <label for="color-by">Color by:</label>
+                    <select id="color-by" name="color_by" onchange="this.form.submit()">
+                        <option value="country" {% if color_by != 'health' %}selected{% endif %}>Country</option>
+                        <option value="health" {% if color_by == 'health' %}selected{% endif %}>Health</option>
+                    </select>
+                </div>
+            </form>
         </div>
         
         
@@ -515,7 +1060,7 @@ def index():
             </div>
             <div class="card-content">
                 {% if ndvi_available %}
-                <img src="{{ url_for('get_ndvi_image', lat=lat, lon=lon) }}" alt="NDVI Image">
+                <img src="{{ ndvi_image_url }}" alt="NDVI Image">
                 {% else %}
                 <div class="placeholder-message">Select a point on the map to calculate NDVI</div>
                 {% endif %}
@@ -843,33 +1388,262 @@ def index():
     
     
     
-    ''', map_html=map_html, ndvi_available=ndvi_available, lat=lat, lon=lon, country_data_json=country_data_json, product_data_json=product_data_json, pest_data_json=pest_data_json,
-                           pest_image_path=pest_image_path)
+    '''
 
 
 
-# Route to generate NDVI dynamically without saving it
+# Route to generate NDVI dynamically without saving it.
+# /ndvi_image/<lat>/<lon>?start_date=...&end_date=... is immutable: the URL
+# pins every input, so browsers and proxies may cache it for a year.
 @app.route("/ndvi_image/<lat>/<lon>")
 def get_ndvi_image(lat, lon):
     lat, lon = float(lat), float(lon)
-    ndvi_image, _, _ = generate_ndvi_plot(lat, lon)  # Correctly unpack 3 values
+    start_date = request.args.get("start_date")
+    end_date = request.args.get("end_date")
+    try:
+        params = ndvi_analysis.analysis_params(request.args)
+    except ValueError as e:
+        return str(e), 400
+    key = raster_key(lat, lon, start_date or DEFAULT_START_DATE, end_date or DEFAULT_END_DATE, params)
+
+    entry = ndvi_cache_get(key)
+    if entry is not None:
+        metrics.cache_hit("ndvi_image")
+    else:
+        metrics.cache_miss("ndvi_image")
+        ndvi_image, _, _ = generate_ndvi_plot(lat, lon, key[2], key[3], params)  # Correctly unpack 3 values
+        if not ndvi_image:
+            return "No NDVI Image Available", 404
+        entry = ndvi_cache_get(key) or ndvi_cache_put(key, ndvi_image.getvalue())
+
+    return _image_response(entry, immutable=bool(start_date and end_date))
 
-    if ndvi_image:
-        return Response(ndvi_image.getvalue(), mimetype="image/png")
 
-    return "No NDVI Image Available", 404
+# Pest images are overwritten when a point is re-analysed, so they are revalidated via ETag.
+# Keyed by (path, mtime): a rewritten image is a new entry and the stale one is overwritten in time.
+PEST_IMAGE_CACHE_SIZE = int(os.getenv("PEST_IMAGE_CACHE_SIZE", "16"))
+pest_image_cache = LayeredCache("pest_png", PEST_IMAGE_CACHE_SIZE)
+
+
+def pest_image_entry(lat, lon):
+    pest_image_path = f"static/pest_images/pest_{lat}_{lon}.png"
+    try:
+        key = (pest_image_path, os.path.getmtime(pest_image_path))
+    except OSError:
+        return None
+
+    entry = pest_image_cache.get(key, lambda png: _pest_image_entry(png, key))
+    if entry is not None:
+        return entry
+    with open(pest_image_path, "rb") as file:
+        png_bytes = file.read()
+    return pest_image_cache.put(key, _pest_image_entry(png_bytes, key), png_bytes)
+
+
+# Pest pixels are thresholded output, so never serve them lossy
+def _pest_image_entry(png_bytes, key):
+    return {**_image_entry(png_bytes, pest_image_cache.shared_key(key)), "formats": http_cache.LOSSLESS_FORMATS}
 
 
 @app.route("/pest_image/<lat>/<lon>")
 def get_pest_image(lat, lon):
-    pest_image_path = f"static/pest_images/pest_{lat}_{lon}.png"
+    entry = pest_image_entry(lat, lon)
 
-    if os.path.exists(pest_image_path):
-        return Response(open(pest_image_path, "rb").read(), mimetype="image/png")
-    
+    if entry is not None:
+        metrics.cache_hit("pest_image")
+        return _image_response(entry, immutable=False)
+
+    metrics.cache_miss("pest_image")
     return "No Pest Detection Image Available", 404
 
 
+# ETag / 304 / Accept-negotiated (png, webp, avif) response for a cached image entry
+def _image_response(entry, immutable):
+    status, body, mimetype, headers = http_cache.image_response_parts(
+        entry, request.headers.get("Accept"), request.headers.get("If-None-Match"), immutable)
+    response = Response(body, status=status, mimetype=mimetype)
+    response.headers.update(headers)
+    return response
+
+
+# Farm points with their pest scores, optionally filtered (?status=Diseased), served from memory
+@app.route("/api/points")
+def get_points():
+    refresh_dataset()
+    points = filter_points(request.args.get("status") or None)
+    columns = ["LATITUD", "LONGITUD", "country"] + PEST_SCORE_COLUMNS
+    records = points[columns].astype(object).where(points[columns].notnull(), None).to_dict(orient="records")
+    return Response(json.dumps(records), mimetype="application/json")
+
+
+# Upload a farm inventory: multipart form with `file` (CSV or GeoJSON) and `country`.
+# The file is streamed in chunks; the map and stats include the new points on the next request.
+# Disabled unless INGEST_TOKEN is set; clients send it as "Authorization: Bearer <token>".
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", str(ingest.DEFAULT_CHUNK_SIZE)))
+INGEST_TOKEN = os.getenv("INGEST_TOKEN", "")
+
+
+@app.route("/ingest", methods=["POST"])
+def ingest_inventory():
+    if not INGEST_TOKEN:
+        return _json_response({"error": "Ingestion is disabled (INGEST_TOKEN is not set)"}, 403)
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode("utf-8"), INGEST_TOKEN.encode("utf-8")):
+        return _json_response({"error": "Missing or invalid ingest token"}, 401)
+
+    upload = request.files.get("file")
+    if upload is None:
+        return _json_response({"error": "No file uploaded"}, 400)
+
+    try:
+        country = validate_country(request.form.get("country"))
+        fmt = ingest.detect_format(upload.filename, request.form.get("format"))
+        with metrics.timed("ingest"), inventory_appender(country) as append_points:
+            stats = ingest.ingest_stream(upload.stream, fmt, country, append_points,
+                                         inventory_product_column(), INGEST_CHUNK_SIZE)
+    except ingest.IngestError as e:
+        # Earlier chunks were appended; report how far the file got
+        return _json_response({"error": str(e), **e.stats}, 400)
+    except ValueError as e:
+        return _json_response({"error": str(e)}, 400)
+
+    return _json_response(stats)
+
+
+# Pest statistics for one point with custom analysis parameters, e.g.
+# /api/pest_analysis/-12.05/-77.04?start_date=2021-01-01&end_date=2021-12-31&pixel_threshold=80
+# The NDVI raster comes from cache when available, so only the OpenCV stage re-runs.
+@app.route("/api/pest_analysis/<lat>/<lon>")
+def get_pest_analysis(lat, lon):
+    try:
+        lat, lon = float(lat), float(lon)
+        params = ndvi_analysis.analysis_params(request.args)
+    except ValueError as e:
+        return _json_response({"error": str(e)}, 400)
+    start_date = request.args.get("start_date") or DEFAULT_START_DATE
+    end_date = request.args.get("end_date") or DEFAULT_END_DATE
+
+    try:
+        image_np = fetch_ndvi_array(lat, lon, start_date, end_date, params)
+    except Exception as e:
+        print(f"⚠️ NDVI Image Download Failed: {e}")
+        return _json_response({"error": "No NDVI data available"}, 404)
+
+    with metrics.timed("pest_analysis.opencv"):
+        _, pest_density = ndvi_analysis.detect_pests(image_np, params)
+    return _json_response({"params": params, **ndvi_analysis.pest_summary(lat, lon, pest_density, params)})
+
+
+# Evaluate many threshold combinations over one raster in a single pass.
+# POST JSON: {"lat": .., "lon": .., "start_date": .., "end_date": .., "buffer": .., "scale": ..,
+#             "grid": {"canny_low": [30, 50], "pixel_threshold": [80, 100, 120], ...}}
+@app.route("/api/pest_sweep", methods=["POST"])
+def pest_sweep():
+    body = request.get_json(silent=True) or {}
+    try:
+        lat, lon = float(body["lat"]), float(body["lon"])
+        raster_params = ndvi_analysis.analysis_params({name: body.get(name) for name in ndvi_analysis.RASTER_PARAMS})
+        grid = body.get("grid") or {}
+        if not isinstance(grid, dict):
+            raise ValueError("grid must be an object of parameter lists")
+    except (KeyError, TypeError, ValueError) as e:
+        return _json_response({"error": f"Invalid sweep request: {e}"}, 400)
+    start_date = body.get("start_date") or DEFAULT_START_DATE
+    end_date = body.get("end_date") or DEFAULT_END_DATE
+
+    try:
+        image_np = fetch_ndvi_array(lat, lon, start_date, end_date, raster_params)
+    except Exception as e:
+        print(f"⚠️ NDVI Image Download Failed: {e}")
+        return _json_response({"error": "No NDVI data available"}, 404)
+
+    try:
+        with metrics.timed("pest_sweep.opencv"):
+            results = ndvi_analysis.sweep_pest_params(image_np, grid, body.get("base_params"))
+    except ValueError as e:
+        return _json_response({"error": str(e)}, 400)
+
+    return _json_response({
+        "lat": lat, "lon": lon, "start_date": start_date, "end_date": end_date,
+        "buffer": raster_params["buffer"], "scale": raster_params["scale"],
+        "results": results
+    })
+
+
+# Streaming export of cached pest statistics / NDVI summaries (see export.py), e.g.
+# /export?format=csv&status=Diseased&country=Peru
+# POST JSON: {"format": "zip", "points": [[-12.05, -77.04], ...], "start_date": .., "end_date": ..}
+# Formats: csv, geojson, parquet, zip (images) and pdf (one page per point).
+@app.route("/export", methods=["GET", "POST"])
+def export_results():
+    try:
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            raise ValueError("JSON body must be an object")
+        options = {**request.args.to_dict(), **body}
+        fmt = (options.get("format") or "csv").lower()
+        points = options.get("points")
+        if isinstance(points, str):
+            points = export.parse_points(points)
+        else:
+            points = [(float(lat), float(lon)) for lat, lon in points or []]
+        limit = int(options["limit"]) if options.get("limit") else None
+        params = ndvi_analysis.analysis_params(options)
+        start_date = options.get("start_date") or DEFAULT_START_DATE
+        end_date = options.get("end_date") or DEFAULT_END_DATE
+
+        refresh_dataset()
+        this_module = sys.modules[__name__]  # Works when run as __main__ too
+        selected = export.select_points(this_module, points, options.get("status"),
+                                        options.get("country"), limit)
+        chunks = export.generate_export(this_module, fmt, selected, start_date, end_date, params)
+    except (TypeError, ValueError) as e:
+        return _json_response({"error": f"Invalid export request: {e}"}, 400)
+
+    def stream():
+        with metrics.in_flight("export"), metrics.timed(f"export.{fmt}"):
+            yield from chunks
+
+    mimetype, extension = export.FORMATS[fmt]
+    return Response(stream(), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="ndvi_export.{extension}"'})
+
+
+def _json_response(data, status=200):
+    return Response(json.dumps(data), status=status, mimetype="application/json")
+
+
+# Prometheus scrape endpoint (stage histograms, cache hit ratios, in-flight jobs)
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# Whole-request timing per endpoint, plus opt-in profiling (?profile=1 when ENABLE_PROFILING=1)
+@app.before_request
+def start_profiler():
+    g.request_start = time.perf_counter()
+    if PROFILING_ENABLED and request.args.get("profile") == "1":
+        g.profiler = metrics.RequestProfiler(request.path)
+        g.profiler.start()
+
+
+@app.after_request
+def stop_profiler(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        report_path = profiler.stop()
+        response.headers["X-Profile-Report"] = report_path
+        print(f"🧪 Profile report written to {report_path}")
+
+    request_start = g.pop("request_start", None)
+    if request_start is not None:
+        metrics.observe(f"request.{request.endpoint}", time.perf_counter() - request_start)
+    return response
+
+
 
+# Development server only; in production run `gunicorn -c gunicorn.conf.py wsgi:app`
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")),
+            debug=os.getenv("FLASK_DEBUG", "0") == "1")
@@ -0,0 +1,273 @@
+# Async (ASGI) variant of the dashboard routes: /, /ndvi_image and /pest_image
+#   METRICS_DIR=cache/metrics uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --workers 4
+# (METRICS_DIR makes /metrics report all workers, not just the one scraped)
+#
+# The NDVI lookup is mostly network wait, so instead of holding a thread per
+# request:
+#   - blocking Earth Engine calls run in a bounded thread pool (EE_EXECUTOR)
+#   - the GeoTIFF download uses an async HTTP client (httpx)
+#   - OpenCV / matplotlib / PNG encoding run in a separate process pool
+# which lets a single process hold hundreds of concurrent lookups.
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode
+
+import httpx
+from jinja2 import Environment
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import HTMLResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+import ap
+import http_cache
+import metrics
+import ndvi_analysis
+
+# Max Earth Engine calls in flight per process
+EE_MAX_CONCURRENCY = int(os.getenv("EE_MAX_CONCURRENCY", "32"))
+# Processes for the CPU-bound image steps
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", max(1, multiprocessing.cpu_count() // 2)))
+
+EE_EXECUTOR = ThreadPoolExecutor(max_workers=EE_MAX_CONCURRENCY, thread_name_prefix="ee")
+# "spawn" so pool workers only import ndvi_analysis, not the event loop's threads
+CPU_POOL = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+# Same autoescaping as Flask's render_template_string
+jinja_env = Environment(autoescape=True)
+dashboard_template = jinja_env.from_string(ap.DASHBOARD_TEMPLATE)
+
+http_client = None
+
+
+# NDVI raster for a point, from the shared caches or Earth Engine + httpx
+async def fetch_ndvi_array_async(lat, lon, start_date, end_date, params):
+    loop = asyncio.get_running_loop()
+    key = ap.raster_key(lat, lon, start_date, end_date, params)
+    image_np = ap.ndvi_array_get(key)
+    if image_np is not None:
+        metrics.cache_hit("ndvi_array")
+        return image_np
+    metrics.cache_miss("ndvi_array")
+
+    with metrics.timed("ndvi.ee_query"):
+        url = await loop.run_in_executor(EE_EXECUTOR, ap.ndvi_download_url, lat, lon, start_date, end_date,
+                                         params["buffer"], params["scale"])
+
+    # Download NDVI GeoTIFF without blocking the event loop
+    with metrics.timed("ndvi.download"):
+        response = await http_client.get(url)
+        response.raise_for_status()
+
+    image_np = await loop.run_in_executor(CPU_POOL, ndvi_analysis.decode_ndvi_geotiff, response.content)
+    return ap.ndvi_array_put(key, image_np)
+
+
+async def generate_ndvi_plot_async(lat, lon, start_date=ap.DEFAULT_START_DATE, end_date=ap.DEFAULT_END_DATE,
+                                   params=None):
+    loop = asyncio.get_running_loop()
+    params = params or ndvi_analysis.analysis_params()
+    with metrics.in_flight("ndvi"), metrics.timed("ndvi.total"):
+        try:
+            try:
+                image_np = await fetch_ndvi_array_async(lat, lon, start_date, end_date, params)
+            except Exception as e:
+                print(f"⚠️ NDVI Image Download Failed: {e}")
+                return None, None, None
+
+            # Plot (if not cached), detect pests and save the pest image in the process pool
+            key = ap.raster_key(lat, lon, start_date, end_date, params)
+            entry = ap.ndvi_cache_get(key)
+            pest_image_path = ap.pest_image_path_for(lat, lon)
+            with metrics.timed("ndvi.analysis"):
+                ndvi_png, pest_data = await loop.run_in_executor(
+                    CPU_POOL, ndvi_analysis.analyze_ndvi, image_np, lat, lon, pest_image_path, params, entry is None)
+
+            ap.remember_pest_data(lat, lon, pest_data, start_date, end_date, params)
+            if entry is None:
+                entry = ap.ndvi_cache_put(key, ndvi_png)
+            return entry["png"], pest_image_path, pest_data
+
+        except Exception as e:
+            print(f"❌ Error in NDVI & Pest Detection Calculation: {e}")
+            return None, None, None
+
+
+async def index(request):
+    ndvi_available = False
+    lat, lon, start_date, end_date = None, None, None, None
+    pest_image_path = None
+    pest_data = None  # Store current pest data
+
+    form = await request.form() if request.method == "POST" else {}
+    status_filter = form.get("status") or request.query_params.get("status") or None
+    color_by = form.get("color_by") or request.query_params.get("color_by", "country")
+
+    # Optional analysis parameters (buffer, scale, canny_low, ...) posted with the form
+    params = ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+
+    if request.method == "POST":
+        try:
+            lat = float(form["latitude"])
+            lon = float(form["longitude"])
+            params = ndvi_analysis.analysis_params(form)
+            ndvi_available = True
+            start_date = form["start_date"] or ap.DEFAULT_START_DATE
+            end_date = form["end_date"] or ap.DEFAULT_END_DATE
+            with metrics.timed("index.ndvi"):
+                _, pest_image_path, pest_data = await generate_ndvi_plot_async(lat, lon, start_date, end_date, params)
+
+        except (KeyError, ValueError):
+            pass  # Ignore invalid input
+
+    # Dataset refresh (file reads, point store publish), map building and stats
+    # are blocking work over the dataframe; keep them all off the loop
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, ap.refresh_dataset)
+    map_html = await loop.run_in_executor(None, ap.create_map, color_by, status_filter)
+    with metrics.timed("index.stats"):
+        country_data_json, product_data_json = await loop.run_in_executor(
+            None, lambda: ap._dashboard_stats_json(ap.filter_points(status_filter)))
+
+    # Pass only the current pest detection data
+    pest_data_json = json.dumps([pest_data]) if pest_data else "[]"
+
+    # The date range (and any non-default raster parameters) are part of the
+    # URL so the image can be cached as immutable
+    ndvi_image_url = None
+    if ndvi_available:
+        ndvi_image_url = request.url_for("get_ndvi_image", lat=str(lat), lon=str(lon)).path
+        ndvi_image_url += "?" + urlencode({"start_date": start_date, "end_date": end_date, **ap.raster_query(params)})
+    with metrics.timed("index.render"):
+        html = dashboard_template.render(map_html=map_html, ndvi_available=ndvi_available,
+                                         ndvi_image_url=ndvi_image_url, country_data_json=country_data_json,
+                                         product_data_json=product_data_json, pest_data_json=pest_data_json,
+                                         pest_image_path=pest_image_path, status_filter=status_filter,
+                                         color_by=color_by, pest_statuses=ap.PEST_STATUSES)
+    return HTMLResponse(html)
+
+
+async def get_ndvi_image(request):
+    lat, lon = float(request.path_params["lat"]), float(request.path_params["lon"])
+    start_date = request.query_params.get("start_date")
+    end_date = request.query_params.get("end_date")
+    try:
+        params = ndvi_analysis.analysis_params(request.query_params)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    key = ap.raster_key(lat, lon, start_date or ap.DEFAULT_START_DATE, end_date or ap.DEFAULT_END_DATE, params)
+
+    entry = ap.ndvi_cache_get(key)
+    if entry is not None:
+        metrics.cache_hit("ndvi_image")
+    else:
+        metrics.cache_miss("ndvi_image")
+        ndvi_image, _, _ = await generate_ndvi_plot_async(lat, lon, key[2], key[3], params)
+        if not ndvi_image:
+            return PlainTextResponse("No NDVI Image Available", status_code=404)
+        entry = ap.ndvi_cache_get(key) or ap.ndvi_cache_put(key, ndvi_image)
+
+    return await image_response(request, entry, immutable=bool(start_date and end_date))
+
+
+async def get_pest_image(request):
+    entry = await asyncio.get_running_loop().run_in_executor(
+        None, ap.pest_image_entry, request.path_params["lat"], request.path_params["lon"])
+
+    if entry is not None:
+        metrics.cache_hit("pest_image")
+        return await image_response(request, entry, immutable=False)
+
+    metrics.cache_miss("pest_image")
+    return PlainTextResponse("No Pest Detection Image Available", status_code=404)
+
+
+# ETag / 304 / Accept-negotiated response; webp/avif encoding runs in the CPU pool
+async def image_response(request, entry, immutable):
+    accept = request.headers.get("accept")
+    if_none_match = request.headers.get("if-none-match")
+    fmt = http_cache.choose_image_format(accept, entry.get("formats", http_cache.PREFERRED_FORMATS))
+    if (fmt != "png" and fmt not in entry["variants"]
+            and not http_cache.etag_matches(if_none_match, f"{entry['etag']}-{fmt}")):
+        entry["variants"][fmt] = await asyncio.get_running_loop().run_in_executor(
+            CPU_POOL, http_cache.encode_variant, entry["png"], fmt)
+
+    status, body, mimetype, headers = http_cache.image_response_parts(entry, accept, if_none_match, immutable)
+    return Response(body, status_code=status, media_type=mimetype, headers=headers)
+
+
+async def get_metrics(request):
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+# Whole-request timing per endpoint (the same request.<endpoint> stages as
+# ap.py), plus opt-in profiling (?profile=1 when ENABLE_PROFILING=1). cProfile
+# hooks the event loop thread, so a profile also includes other requests
+# interleaved with this one and none of the EE_EXECUTOR / CPU_POOL work; only
+# one runs at a time.
+profiling = False
+
+
+async def time_and_profile(request, call_next):
+    global profiling
+    request_start = time.perf_counter()
+    profiler = None
+    if ap.PROFILING_ENABLED and request.query_params.get("profile") == "1" and not profiling:
+        profiling = True
+        profiler = metrics.RequestProfiler(request.url.path)
+        profiler.start()
+
+    try:
+        response = await call_next(request)
+    finally:
+        if profiler is not None:
+            report_path = profiler.stop()
+            profiling = False
+            print(f"🧪 Profile report written to {report_path}")
+    if profiler is not None:
+        response.headers["X-Profile-Report"] = report_path
+
+    metrics.observe(f"request.{_endpoint_name(request)}", time.perf_counter() - request_start)
+    return response
+
+
+# Route function name, like Flask's request.endpoint (None when nothing matched)
+def _endpoint_name(request):
+    endpoint = request.scope.get("endpoint")
+    if isinstance(endpoint, StaticFiles):
+        return "static"
+    return getattr(endpoint, "__name__", None)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client
+    limits = httpx.Limits(max_connections=EE_MAX_CONCURRENCY * 2, max_keepalive_connections=EE_MAX_CONCURRENCY)
+    http_client = httpx.AsyncClient(timeout=ap.NDVI_DOWNLOAD_TIMEOUT, limits=limits, follow_redirects=True)
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        EE_EXECUTOR.shutdown(wait=False)
+        CPU_POOL.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route("/", index, methods=["GET", "POST"]),
+        Route("/ndvi_image/{lat}/{lon}", get_ndvi_image, name="get_ndvi_image"),
+        Route("/pest_image/{lat}/{lon}", get_pest_image, name="get_pest_image"),
+        Route("/metrics", get_metrics),
+        # Precomputed NDVI / pest tile layers (static/tiles) that the map overlays load
+        Mount("/static", StaticFiles(directory="static"), name="static"),
+    ],
+    middleware=[Middleware(BaseHTTPMiddleware, dispatch=time_and_profile)],
+    lifespan=lifespan,
+)
@@ -0,0 +1,328 @@
+# Export pest statistics, NDVI summaries and images for a set of points
+#   python export.py --format csv --out report.csv --status Diseased
+#   python export.py --format zip --out images.zip --country Peru
+#   python export.py --format pdf --out report.pdf --points "-12.05,-77.04;-13.5,-71.9"
+#
+# Everything comes from results that already exist: pest data from this or
+# any other worker (shared cache), pest scores written by score_points.py,
+# NDVI rasters / plots from the caches and pest images in static/pest_images.
+# Only results for the requested date window and parameters are used, so a
+# row never mixes two analyses. Nothing is recomputed; points without results
+# are exported with empty fields (or skipped, for images). Output is produced
+# one point at a time, so memory stays bounded however many points are
+# exported. The same generators back GET/POST /export in ap.py.
+import argparse
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import ndvi_analysis
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # In requirements.txt; only Parquet export needs it
+    pa = None
+    pq = None
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "geojson": ("application/geo+json", "geojson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "zip": ("application/zip", "zip"),
+    "pdf": ("application/pdf", "pdf"),
+}
+
+RECORD_FIELDS = ["lat", "lon", "country", "diseased_area", "healthy_area", "status", "source",
+                 "ndvi_mean", "ndvi_median", "ndvi_min", "ndvi_max", "ndvi_pixels",
+                 "has_ndvi_image", "has_pest_image"]
+
+# Rows per Parquet row group / bytes per streamed file chunk
+PARQUET_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# (lat, lon, country) for each requested point. points: list of (lat, lon)
+# pairs, or None to select from the dataset by status / country.
+def select_points(ap, points=None, status=None, country=None, limit=None):
+    if points:
+        lookup = {(lat, lon): c for lat, lon, c in ap.df[["LATITUD", "LONGITUD", "country"]].itertuples(index=False)}
+        selected = [(lat, lon, lookup.get((lat, lon))) for lat, lon in points]
+    else:
+        rows = ap.filter_points(status)
+        if country:
+            rows = rows[rows["country"] == country]
+        selected = rows[["LATITUD", "LONGITUD", "country"]].drop_duplicates(["LATITUD", "LONGITUD"])
+        selected = list(selected.itertuples(index=False, name=None))
+    return selected[:limit] if limit else selected
+
+
+def parse_points(value):
+    points = []
+    for pair in (value or "").split(";"):
+        if pair.strip():
+            lat, lon = pair.split(",")
+            points.append((float(lat), float(lon)))
+    return points
+
+
+# NDVI statistics of a cached raster (pixel values are NDVI * 255, negatives clipped to 0)
+def ndvi_summary(image_np):
+    ndvi = image_np.astype(np.float32) / 255.0
+    return {
+        "ndvi_mean": round(float(ndvi.mean()), 4),
+        "ndvi_median": round(float(np.median(ndvi)), 4),
+        "ndvi_min": round(float(ndvi.min()), 4),
+        "ndvi_max": round(float(ndvi.max()), 4),
+        "ndvi_pixels": int(ndvi.size),
+    }
+
+
+# One record per point from cached results only
+def iter_records(ap, points, start_date, end_date, params=None):
+    params = params or ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    scores = _score_lookup(ap, start_date, end_date, params)
+
+    for lat, lon, country in points:
+        record = dict.fromkeys(RECORD_FIELDS)
+        record.update({"lat": lat, "lon": lon, "country": country})
+
+        # Interactive analysis first (most recent), then the batch score
+        pest_data = ap.lookup_pest_data(lat, lon, start_date, end_date, params)
+        if pest_data is not None:
+            record.update(diseased_area=pest_data["diseased_area"], healthy_area=pest_data["healthy_area"],
+                          status=pest_data.get("status"), source="analysis")
+        elif (lat, lon) in scores:
+            diseased_area, healthy_area, status = scores[(lat, lon)]
+            record.update(diseased_area=diseased_area, healthy_area=healthy_area, status=status, source="score")
+
+        key = ap.raster_key(lat, lon, start_date, end_date, params)
+        image_np = ap.ndvi_array_get(key)
+        if image_np is not None:
+            record.update(ndvi_summary(image_np))
+        record["has_ndvi_image"] = ap.ndvi_cache_get(key) is not None
+        # The pest image is rewritten by every analysis of the point; it belongs
+        # to this window / params only if the remembered analysis does
+        record["has_pest_image"] = pest_data is not None and os.path.exists(ap.pest_image_path_for(lat, lon))
+        yield record
+
+
+# Latest batch score per point for this date window and parameter set
+def _score_lookup(ap, start_date, end_date, params):
+    if not os.path.exists(ap.PEST_SCORES_PATH):
+        return {}
+    scores = pd.read_csv(ap.PEST_SCORES_PATH, dtype={"start_date": str, "end_date": str, "params": str})
+    params_column = scores["params"].fillna("{}") if "params" in scores.columns else "{}"
+    scores = scores[(scores["start_date"] == start_date) & (scores["end_date"] == end_date)
+                    & (params_column == ndvi_analysis.params_label(params))]
+    scores = scores.sort_values("scored_at").drop_duplicates(["LATITUD", "LONGITUD"], keep="last")
+    return {
+        (lat, lon): (diseased_area, healthy_area, status)
+        for lat, lon, diseased_area, healthy_area, status in
+        scores[["LATITUD", "LONGITUD", "diseased_area", "healthy_area", "pest_status"]].itertuples(index=False)
+    }
+
+
+# ---------------------- WRITERS (each yields bytes) ---------------------- #
+
+def stream_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=RECORD_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        if buffer.tell() >= STREAM_CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def stream_geojson(records):
+    yield b'{"type": "FeatureCollection", "features": ['
+    separator = b""
+    for record in records:
+        properties = {key: value for key, value in record.items() if key not in ("lat", "lon")}
+        feature = {"type": "Feature",
+                   "geometry": {"type": "Point", "coordinates": [record["lon"], record["lat"]]},
+                   "properties": properties}
+        yield separator + json.dumps(feature).encode("utf-8")
+        separator = b",\n"
+    yield b"]}\n"
+
+
+def stream_parquet(records):
+    if pq is None:
+        raise ValueError("Parquet export needs pyarrow (pip install pyarrow)")
+
+    schema = pa.schema([
+        ("lat", pa.float64()), ("lon", pa.float64()), ("country", pa.string()),
+        ("diseased_area", pa.float64()), ("healthy_area", pa.float64()),
+        ("status", pa.string()), ("source", pa.string()),
+        ("ndvi_mean", pa.float64()), ("ndvi_median", pa.float64()),
+        ("ndvi_min", pa.float64()), ("ndvi_max", pa.float64()), ("ndvi_pixels", pa.int64()),
+        ("has_ndvi_image", pa.bool_()), ("has_pest_image", pa.bool_()),
+    ])
+
+    # Parquet needs a seekable file for its footer; write row groups to a temp file, then stream it
+    with tempfile.TemporaryFile() as tmp:
+        with pq.ParquetWriter(tmp, schema, compression="zstd") as writer:
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= PARQUET_BATCH_SIZE:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        yield from _stream_file(tmp)
+
+
+# Write-only file object that hands its bytes to the caller as they are written,
+# so zipfile can produce an archive without holding it in memory
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# ZIP with ndvi_<lat>_<lon>.png / pest_<lat>_<lon>.png per point plus summary.csv.
+# The summary goes last, so its rows are spooled to a temp file until then.
+def stream_zip(ap, records, start_date, end_date, params=None):
+    params = params or ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    sink = _ChunkSink()
+
+    with tempfile.TemporaryFile("w+", newline="", encoding="utf-8") as summary:
+        summary_writer = csv.DictWriter(summary, fieldnames=RECORD_FIELDS)
+        summary_writer.writeheader()
+
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:  # PNGs are already compressed
+            for record in records:
+                summary_writer.writerow(record)
+                for name, png_bytes in _point_images(ap, record, start_date, end_date, params):
+                    archive.writestr(name, png_bytes)
+                    yield sink.drain()
+
+            info = zipfile.ZipInfo("summary.csv", date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            summary.seek(0)
+            with archive.open(info, "w") as entry:
+                for chunk in iter(lambda: summary.read(STREAM_CHUNK_SIZE), ""):
+                    entry.write(chunk.encode("utf-8"))
+                    yield sink.drain()
+        yield sink.drain()
+
+
+def _point_images(ap, record, start_date, end_date, params):
+    lat, lon = record["lat"], record["lon"]
+    if record["has_ndvi_image"]:
+        entry = ap.ndvi_cache_get(ap.raster_key(lat, lon, start_date, end_date, params))
+        if entry is not None:
+            yield f"ndvi_{lat}_{lon}.png", entry["png"]
+    if record["has_pest_image"]:
+        with open(ap.pest_image_path_for(lat, lon), "rb") as file:
+            yield f"pest_{lat}_{lon}.png", file.read()
+
+
+# Multi-page PDF: one page per point with its stats and cached images
+def stream_pdf(ap, records, start_date, end_date, params=None):
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.figure import Figure
+    from PIL import Image
+
+    params = params or ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    with tempfile.TemporaryFile() as tmp:
+        with PdfPages(tmp) as pdf:
+            for record in records:
+                fig = Figure(figsize=(8.27, 11.69))  # A4 portrait
+                fig.suptitle(f"Lat: {record['lat']}, Lon: {record['lon']} ({record['country'] or 'unknown'})")
+                lines = [f"{field}: {record[field]}" for field in RECORD_FIELDS[3:12] if record[field] is not None]
+                fig.text(0.08, 0.9, "\n".join(lines) or "No cached results", va="top", family="monospace", fontsize=9)
+
+                images = list(_point_images(ap, record, start_date, end_date, params))
+                for i, (name, png_bytes) in enumerate(images):
+                    ax = fig.add_axes([0.08, 0.42 - i * 0.38, 0.84, 0.34])
+                    ax.imshow(np.array(Image.open(io.BytesIO(png_bytes))), cmap="gray")
+                    ax.set_title(name, fontsize=9)
+                    ax.axis("off")
+                pdf.savefig(fig)
+        yield from _stream_file(tmp)
+
+
+def _stream_file(file):
+    file.seek(0)
+    while True:
+        chunk = file.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+# Bytes of the export in the requested format, generated lazily
+def generate_export(ap, fmt, points, start_date, end_date, params=None):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format: {fmt} (one of {', '.join(FORMATS)})")
+    if fmt == "parquet" and pq is None:
+        raise ValueError("Parquet export needs pyarrow (pip install pyarrow)")
+
+    records = iter_records(ap, points, start_date, end_date, params)
+    if fmt == "csv":
+        return stream_csv(records)
+    if fmt == "geojson":
+        return stream_geojson(records)
+    if fmt == "parquet":
+        return stream_parquet(records)
+    if fmt == "zip":
+        return stream_zip(ap, records, start_date, end_date, params)
+    return stream_pdf(ap, records, start_date, end_date, params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export cached NDVI / pest results")
+    parser.add_argument("--format", choices=list(FORMATS), default="csv")
+    parser.add_argument("--out", required=True, help="Output file")
+    parser.add_argument("--points", help="Explicit points as 'lat,lon;lat,lon' (default: select from dataset)")
+    parser.add_argument("--status", help="Only points with this pest status (Healthy, Moderate, Diseased, Unscored)")
+    parser.add_argument("--country")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--start-date")
+    parser.add_argument("--end-date")
+    args = parser.parse_args()
+
+    import ap
+
+    points = select_points(ap, parse_points(args.points), args.status, args.country, args.limit)
+    start_date = args.start_date or ap.DEFAULT_START_DATE
+    end_date = args.end_date or ap.DEFAULT_END_DATE
+
+    with open(args.out, "wb") as out:
+        for chunk in generate_export(ap, args.format, points, start_date, end_date):
+            out.write(chunk)
+    print(f"✅ Exported {len(points)} points to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Gunicorn settings for serving the NDVI dashboard in production
+#   gunicorn -c gunicorn.conf.py wsgi:app
+import gc
+import multiprocessing
+import os
+import shutil
+
+# Earth Engine must be initialised per worker, not in the preloading master
+os.environ.setdefault("DEFER_EE_INIT", "1")
+
+# Workers write metric snapshots here and /metrics sums them (see metrics.py)
+os.environ.setdefault("METRICS_DIR", os.path.join(os.getenv("SHARED_CACHE_DIR", "cache"), "metrics"))
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# Load ap (and its CSV dataset) once in the master before forking so workers
+# start out sharing the dataframe's pages (copy-on-write: a worker's first
+# refresh_dataset/refresh_pest_scores gives it a private copy)
+preload_app = True
+
+# The NDVI path mostly waits on Earth Engine, so use a few processes with
+# many threads each rather than one process per request
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+
+# Earth Engine download + analysis can take well over the 30s default
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to cap any slow memory growth
+max_requests = 1000
+max_requests_jitter = 100
+
+accesslog = "-"
+
+
+def on_starting(server):
+    # Counters start from zero with each server, not where the last run stopped
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+
+
+def when_ready(server):
+    # Move everything loaded so far out of the GC's tracked generations so the
+    # collector doesn't touch (and un-share) those pages in the workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import ap
+    ap.init_earth_engine()
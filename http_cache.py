@@ -0,0 +1,116 @@
+# HTTP caching helpers for generated images, shared by ap.py (Flask) and
+# asgi_app.py (Starlette): content-hashed ETags, conditional GETs and
+# WebP/AVIF variants picked from the Accept header.
+import hashlib
+import io
+
+from PIL import Image, features
+
+# One year; safe because the URL includes everything the image depends on
+IMMUTABLE_MAX_AGE = 31536000
+
+MIMETYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+# Smallest first; only formats this Pillow build can write are offered
+PREFERRED_FORMATS = [fmt for fmt in ("avif", "webp") if fmt in features.get_supported_modules()] + ["png"]
+
+# AVIF is encoded lossily, so images whose pixels must stay exact (the pest
+# detection overlay) are only offered as lossless webp or png
+LOSSLESS_FORMATS = [fmt for fmt in PREFERRED_FORMATS if fmt != "avif"]
+
+
+def content_etag(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+# q-value of a mimetype in an Accept header (0 if absent)
+def _accept_quality(accept_header, mimetype):
+    best = 0.0
+    for part in (accept_header or "").split(","):
+        fields = [field.strip() for field in part.split(";")]
+        if fields[0] not in (mimetype, mimetype.split("/")[0] + "/*", "*/*"):
+            continue
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith("q="):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        # An exact match wins over wildcards
+        if fields[0] == mimetype:
+            return quality
+        best = max(best, quality)
+    return best
+
+
+# Pick avif/webp (from formats) when the client explicitly asks for it,
+# otherwise png. Wildcards alone don't count: browsers send */* for <img>
+# requests they can't decode those formats for.
+def choose_image_format(accept_header, formats=PREFERRED_FORMATS):
+    for fmt in formats[:-1]:
+        mimetype = MIMETYPES[fmt]
+        if mimetype in (accept_header or "") and _accept_quality(accept_header, mimetype) > 0:
+            return fmt
+    return "png"
+
+
+# Re-encode a PNG as webp (lossless) or avif (lossy, see LOSSLESS_FORMATS)
+def encode_variant(png_bytes, fmt):
+    if fmt == "png":
+        return png_bytes
+    image = Image.open(io.BytesIO(png_bytes))
+    out = io.BytesIO()
+    if fmt == "webp":
+        image.save(out, format="WEBP", lossless=True, method=4)
+    else:
+        image.convert("RGB").save(out, format="AVIF", quality=80)
+    return out.getvalue()
+
+
+# True if an If-None-Match header matches the given (unquoted) etag
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/").strip('"') == etag for tag in candidates)
+
+
+# Headers for an image response; immutable only when the URL pins every input
+def cache_headers(etag, fmt, content_length, immutable):
+    if immutable:
+        cache_control = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        cache_control = "public, no-cache"  # Always revalidate; a 304 costs nothing
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": cache_control,
+        "Vary": "Accept",
+    }
+    if content_length is not None:
+        headers["Content-Length"] = str(content_length)
+    return headers
+
+
+# Full conditional-GET handling for one cached image entry.
+# entry is a dict {"png": bytes, "etag": str, "variants": {fmt: bytes}}
+# (variants is filled lazily) with an optional "formats" list to offer instead
+# of PREFERRED_FORMATS. Returns (status, body, mimetype, headers).
+def image_response_parts(entry, accept_header, if_none_match, immutable):
+    fmt = choose_image_format(accept_header, entry.get("formats", PREFERRED_FORMATS))
+    etag = f"{entry['etag']}-{fmt}"
+
+    if etag_matches(if_none_match, etag):
+        return 304, b"", MIMETYPES[fmt], cache_headers(etag, fmt, None, immutable)
+
+    variants = entry.setdefault("variants", {})
+    body = variants.get(fmt)
+    if body is None:
+        body = variants[fmt] = encode_variant(entry["png"], fmt)
+    return 200, body, MIMETYPES[fmt], cache_headers(etag, fmt, len(body), immutable)
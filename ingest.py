@@ -0,0 +1,164 @@
+# Streaming ingestion of new farm inventories (CSV or GeoJSON)
+#   python ingest.py farms_chile.csv --country Chile
+#   python ingest.py farms.geojson --country Chile --chunk-size 20000
+#
+# Files are read in chunks, coordinates and product columns are normalised to
+# the dataset's LATITUD / LONGITUD / product column, invalid and duplicate
+# points are dropped, and the rest is appended to data/inventory/<country>.csv.
+# Running servers pick the new rows up on their next request (see
+# ap.refresh_dataset), so no restart is needed. The same code backs the
+# POST /ingest endpoint in ap.py (enabled by setting INGEST_TOKEN).
+import argparse
+import json
+import os
+
+import pandas as pd
+
+try:
+    import ijson  # In requirements.txt: lets GeoJSON be parsed without loading it whole
+    JSON_ERRORS = (ijson.JSONError,)
+except ImportError:
+    ijson = None
+    JSON_ERRORS = ()
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Without ijson a GeoJSON file is parsed whole in memory, so larger files are refused
+GEOJSON_MAX_BYTES_WITHOUT_IJSON = int(os.getenv("GEOJSON_MAX_BYTES_WITHOUT_IJSON", str(50 * 1024 * 1024)))
+
+# Accepted spellings of the coordinate columns (compared case-insensitively)
+LATITUDE_NAMES = ("latitud", "latitude", "lat")
+LONGITUDE_NAMES = ("longitud", "longitude", "lon", "lng", "long")
+
+# Same detection as the dashboard's product chart
+PRODUCT_COLUMNS = ["PRODUCTO/CULTIVO", "Producto", "PRODUCTO"]
+
+
+def _find_column(columns, names):
+    for column in columns:
+        if str(column).strip().lower() in names:
+            return column
+    return None
+
+
+# Raised when a file fails part-way; stats counts what was already appended
+class IngestError(ValueError):
+    def __init__(self, message, stats):
+        super().__init__(message)
+        self.stats = stats
+
+
+# Parse coordinates written as numbers or as strings with a decimal comma
+def _to_float(series):
+    return pd.to_numeric(series.astype(str).str.strip().str.replace(",", ".", regex=False), errors="coerce")
+
+
+# Normalise one chunk to [LATITUD, LONGITUD, product_column] and drop rows
+# with missing or out-of-range coordinates. Returns (rows, invalid_count).
+def normalize_chunk(chunk, product_column):
+    lat_column = _find_column(chunk.columns, LATITUDE_NAMES)
+    lon_column = _find_column(chunk.columns, LONGITUDE_NAMES)
+    if lat_column is None or lon_column is None:
+        raise ValueError("Input needs latitude and longitude columns (e.g. LATITUD and LONGITUD)")
+    source_product = next((col for col in PRODUCT_COLUMNS if col in chunk.columns), None)
+
+    rows = pd.DataFrame({
+        "LATITUD": _to_float(chunk[lat_column]),
+        "LONGITUD": _to_float(chunk[lon_column]),
+        product_column: chunk[source_product].astype("string").str.strip() if source_product else pd.NA,
+    })
+
+    valid = (rows["LATITUD"].between(-90, 90) & rows["LONGITUD"].between(-180, 180)
+             & ~((rows["LATITUD"] == 0) & (rows["LONGITUD"] == 0)))  # 0,0 is a blank cell, not a farm
+    return rows[valid], int((~valid).sum())
+
+
+def read_csv_chunks(stream, chunk_size):
+    yield from pd.read_csv(stream, chunksize=chunk_size, dtype=str)
+
+
+# GeoJSON FeatureCollection of Point features -> chunks of flat rows
+# (LONGITUD/LATITUD from the geometry plus the feature's properties)
+def read_geojson_chunks(stream, chunk_size):
+    if ijson is not None:
+        features = ijson.items(stream, "features.item", use_float=True)
+    else:
+        data = stream.read(GEOJSON_MAX_BYTES_WITHOUT_IJSON + 1)
+        if len(data) > GEOJSON_MAX_BYTES_WITHOUT_IJSON:
+            raise ValueError(f"GeoJSON over {GEOJSON_MAX_BYTES_WITHOUT_IJSON} bytes needs ijson "
+                             "installed to be streamed")
+        features = json.loads(data).get("features", [])
+
+    rows = []
+    for feature in features:
+        if not isinstance(feature, dict):
+            raise ValueError(f"GeoJSON features must be objects, got {type(feature).__name__}")
+        geometry = feature.get("geometry") or {}
+        coordinates = geometry.get("coordinates") if geometry.get("type") == "Point" else None
+        row = dict(feature.get("properties") or {})
+        row["LONGITUD"], row["LATITUD"] = (coordinates[:2] if coordinates and len(coordinates) >= 2
+                                           else (None, None))
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            yield pd.DataFrame(rows)
+            rows = []
+    if rows:
+        yield pd.DataFrame(rows)
+
+
+def detect_format(filename, fmt=None):
+    if fmt:
+        return fmt.lower()
+    extension = os.path.splitext(filename or "")[1].lower()
+    return "geojson" if extension in (".geojson", ".json") else "csv"
+
+
+# Stream a file through normalisation into append_points(rows, country),
+# which returns (added, duplicates). Returns counts for the whole file.
+def ingest_stream(stream, fmt, country, append_points, product_column, chunk_size=DEFAULT_CHUNK_SIZE):
+    readers = {"csv": read_csv_chunks, "geojson": read_geojson_chunks}
+    if fmt not in readers:
+        raise ValueError(f"Unsupported format: {fmt} (use csv or geojson)")
+
+    stats = {"country": country, "rows": 0, "invalid": 0, "duplicates": 0, "added": 0}
+    try:
+        for chunk in readers[fmt](stream, chunk_size):
+            rows, invalid = normalize_chunk(chunk, product_column)
+            added, duplicates = append_points(rows, country)
+            stats["rows"] += len(chunk)
+            stats["invalid"] += invalid
+            stats["duplicates"] += duplicates
+            stats["added"] += added
+            print(f"📥 {country}: {stats['rows']} rows read, {stats['added']} added")
+    except (ValueError, TypeError, AttributeError, pd.errors.ParserError, *JSON_ERRORS) as e:
+        # Malformed input; chunks before this one are already appended
+        raise IngestError(f"Invalid {fmt} input after {stats['rows']} rows: {e}", stats) from e
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a CSV or GeoJSON farm inventory")
+    parser.add_argument("path")
+    parser.add_argument("--country", required=True, help="Country the points belong to")
+    parser.add_argument("--format", choices=["csv", "geojson"], help="Default: from the file extension")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    import ap
+
+    fmt = detect_format(args.path, args.format)
+    mode = "r" if fmt == "csv" else "rb"
+    country = ap.validate_country(args.country)
+    with open(args.path, mode, **({"encoding": "utf-8"} if mode == "r" else {})) as stream, \
+            ap.inventory_appender(country) as append_points:
+        try:
+            stats = ingest_stream(stream, fmt, country, append_points,
+                                  ap.inventory_product_column(), args.chunk_size)
+        except IngestError as e:
+            print(f"❌ {e} ({json.dumps(e.stats)})")
+            raise SystemExit(1)
+    print(f"✅ {json.dumps(stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import atexit
+import cProfile
+import fcntl
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram buckets (seconds) used for every stage timer
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+
+# stage -> {"buckets": [...], "sum": float, "count": int}
+_histograms = {}
+
+# cache name -> {"hit": int, "miss": int}
+_cache_stats = {}
+
+# job name -> number of requests currently running it
+_in_flight = {}
+
+# Directory where ?profile=1 reports are written
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Multi-process servers (gunicorn sets this, see gunicorn.conf.py): each process
+# snapshots its metrics to METRICS_DIR/<pid>-<start>.json, at most once per
+# METRICS_FLUSH_INTERVAL and on exit, and /metrics sums every snapshot, so
+# whichever worker answers the scrape reports the whole server. Snapshots of
+# exited workers are folded into archive.json so counters never go backwards;
+# in-flight gauges only count live processes.
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+_ARCHIVE_NAME = "archive.json"
+
+_started = time.time_ns()
+_last_flush = 0.0
+
+
+def observe(stage, seconds):
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+                break
+        hist["sum"] += seconds
+        hist["count"] += 1
+    _maybe_flush()
+
+
+# Time a block of code and record it under the given stage name
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def cache_hit(name):
+    with _lock:
+        _cache_stats.setdefault(name, {"hit": 0, "miss": 0})["hit"] += 1
+    _maybe_flush()
+
+
+def cache_miss(name):
+    with _lock:
+        _cache_stats.setdefault(name, {"hit": 0, "miss": 0})["miss"] += 1
+    _maybe_flush()
+
+
+# Count a job as in-flight for the duration of the block
+@contextmanager
+def in_flight(job):
+    with _lock:
+        _in_flight[job] = _in_flight.get(job, 0) + 1
+    _maybe_flush()
+    try:
+        yield
+    finally:
+        with _lock:
+            _in_flight[job] -= 1
+        _maybe_flush()
+
+
+# ---------------------- MULTI-PROCESS AGGREGATION ---------------------- #
+
+def _snapshot():
+    with _lock:
+        return json.loads(json.dumps({"histograms": _histograms, "cache": _cache_stats, "in_flight": _in_flight}))
+
+
+def _snapshot_path():
+    return os.path.join(METRICS_DIR, f"{os.getpid()}-{_started}.json")
+
+
+# Write this process's snapshot (atomically, so readers never see half a file)
+def flush():
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    _last_flush = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(_snapshot_path(), _snapshot())
+
+
+def _maybe_flush():
+    if METRICS_DIR and time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except OSError as e:
+            print(f"⚠️ Could not write metrics snapshot: {e}")
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Add snapshot into total (gauges only when include_gauges, i.e. live processes)
+def _merge(total, snapshot, include_gauges=True):
+    for stage, hist in snapshot.get("histograms", {}).items():
+        merged = total["histograms"].setdefault(stage, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], hist["buckets"])]
+        merged["sum"] += hist["sum"]
+        merged["count"] += hist["count"]
+    for name, stats in snapshot.get("cache", {}).items():
+        merged = total["cache"].setdefault(name, {"hit": 0, "miss": 0})
+        merged["hit"] += stats["hit"]
+        merged["miss"] += stats["miss"]
+    if include_gauges:
+        for job, count in snapshot.get("in_flight", {}).items():
+            total["in_flight"][job] = total["in_flight"].get(job, 0) + count
+    return total
+
+
+# Metrics of every process sharing METRICS_DIR (this one up to date, others as of their last flush)
+def _collect():
+    flush()
+    total = {"histograms": {}, "cache": {}, "in_flight": {}}
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as lock_file:
+        # One collector at a time, so an exited worker is archived exactly once
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            archive_path = os.path.join(METRICS_DIR, _ARCHIVE_NAME)
+            archive = _read_json(archive_path) or {"histograms": {}, "cache": {}, "in_flight": {}}
+            archived = False
+
+            for name in sorted(os.listdir(METRICS_DIR)):
+                if not name.endswith(".json") or name == _ARCHIVE_NAME:
+                    continue
+                path = os.path.join(METRICS_DIR, name)
+                snapshot = _read_json(path)
+                if snapshot is None:
+                    continue
+                if _pid_alive(int(name.split("-")[0])):
+                    _merge(total, snapshot)
+                else:
+                    _merge(archive, snapshot, include_gauges=False)
+                    os.remove(path)
+                    archived = True
+
+            if archived:
+                _write_json(archive_path, archive)
+            _merge(total, archive, include_gauges=False)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return total
+
+
+# Forked workers start from empty metrics (the master's are in its own snapshot)
+def _reset_after_fork():
+    global _lock, _started, _last_flush
+    _lock = threading.Lock()
+    _histograms.clear()
+    _cache_stats.clear()
+    _in_flight.clear()
+    _started = time.time_ns()
+    _last_flush = 0.0
+
+
+# Last snapshot on a clean exit (e.g. gunicorn recycling a worker after max_requests)
+def _flush_at_exit():
+    try:
+        flush()
+    except OSError:
+        pass
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(_flush_at_exit)
+
+
+# Render all metrics in the Prometheus text exposition format
+# (summed over every process when METRICS_DIR is set)
+def render_prometheus():
+    snapshot = _collect() if METRICS_DIR else _snapshot()
+    lines = []
+
+    lines.append("# HELP ndvi_stage_seconds Time spent in each request stage")
+    lines.append("# TYPE ndvi_stage_seconds histogram")
+    for stage, hist in sorted(snapshot["histograms"].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, hist["buckets"]):
+            cumulative += count
+            lines.append(f'ndvi_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'ndvi_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+        lines.append(f'ndvi_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+        lines.append(f'ndvi_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+
+    lines.append("# HELP ndvi_cache_requests_total Cache lookups by result")
+    lines.append("# TYPE ndvi_cache_requests_total counter")
+    for name, stats in sorted(snapshot["cache"].items()):
+        lines.append(f'ndvi_cache_requests_total{{cache="{name}",result="hit"}} {stats["hit"]}')
+        lines.append(f'ndvi_cache_requests_total{{cache="{name}",result="miss"}} {stats["miss"]}')
+
+    lines.append("# HELP ndvi_cache_hit_ratio Fraction of cache lookups that hit")
+    lines.append("# TYPE ndvi_cache_hit_ratio gauge")
+    for name, stats in sorted(snapshot["cache"].items()):
+        total = stats["hit"] + stats["miss"]
+        ratio = stats["hit"] / total if total else 0.0
+        lines.append(f'ndvi_cache_hit_ratio{{cache="{name}"}} {ratio:.4f}')
+
+    lines.append("# HELP ndvi_jobs_in_flight Requests currently running each job")
+    lines.append("# TYPE ndvi_jobs_in_flight gauge")
+    for job, count in sorted(snapshot["in_flight"].items()):
+        lines.append(f'ndvi_jobs_in_flight{{job="{job}"}} {count}')
+
+    return "\n".join(lines) + "\n"
+
+
+# Per-request cProfile session, only created when profiling is requested
+class RequestProfiler:
+    def __init__(self, name):
+        self.name = name
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_name = self.name.strip("/").replace("/", "_") or "index"
+        report_path = os.path.join(PROFILE_DIR, f"{safe_name}_{int(time.time() * 1000)}.txt")
+
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(50)
+        with open(report_path, "w", encoding="utf-8") as file:
+            file.write(out.getvalue())
+        return report_path
@@ -0,0 +1,242 @@
+# CPU-only NDVI and pest detection steps.
+# Kept free of Earth Engine / CSV loading so it can be imported cheaply by
+# process-pool workers (see asgi_app.py) as well as by ap.py.
+import io
+import json
+
+import cv2
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Use non-GUI backend to avoid errors
+from matplotlib.figure import Figure
+from PIL import Image
+
+
+# Decode the downloaded NDVI GeoTIFF (file path or raw bytes) to a grayscale array
+def decode_ndvi_geotiff(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    image_pil = Image.open(source).convert("L")  # Convert to grayscale
+    image_np = np.array(image_pil)
+
+    if image_np is None or image_np.size == 0:
+        raise ValueError("NDVI image could not be processed.")
+    return image_np
+
+
+# Render the NDVI colour plot to an in-memory PNG
+def render_ndvi_png(image_np, lat, lon):
+    # Use a standalone Figure instead of pyplot's global state so
+    # several worker threads can render at the same time
+    fig = Figure(figsize=(6, 5))
+    ax = fig.subplots()
+    img_plot = ax.imshow(image_np, cmap='RdYlGn')  # Red-Yellow-Green colormap
+    cbar = fig.colorbar(img_plot, ax=ax)
+    cbar.set_label("NDVI Value")
+    ax.axis("off")
+    ax.set_title(f"NDVI at Lat: {lat}, Lon: {lon}")
+
+    # Convert Matplotlib figure to in-memory image
+    img_bytes = io.BytesIO()
+    fig.savefig(img_bytes, format="png", bbox_inches="tight")
+    img_bytes.seek(0)
+    return img_bytes
+
+
+# Tunable analysis parameters. buffer/scale decide which raster is fetched
+# from Earth Engine; everything else only affects the cheap OpenCV stage and
+# can be changed without downloading the raster again.
+DEFAULT_ANALYSIS_PARAMS = {
+    "buffer": 1000,            # Radius around the point (m)
+    "scale": 10,               # Raster resolution (m/pixel)
+    "canny_low": 50,           # Canny thresholds
+    "canny_high": 150,
+    "edge_weight": 0.7,        # Blend of Canny edges and Laplacian
+    "laplacian_weight": 0.3,
+    "pixel_threshold": 100,    # Blended value above which a pixel counts as diseased
+    "moderate_cutoff": 10,     # Pest density (%) from which status is Moderate
+    "diseased_cutoff": 30,     # Pest density (%) from which status is Diseased
+}
+RASTER_PARAMS = ("buffer", "scale")
+_INT_PARAMS = ("buffer", "canny_low", "canny_high", "pixel_threshold")
+
+# Upper bound on combinations evaluated by one sweep
+MAX_SWEEP_COMBINATIONS = 10000
+
+
+def _coerce_param(name, value):
+    if name not in DEFAULT_ANALYSIS_PARAMS:
+        raise ValueError(f"Unknown analysis parameter: {name}")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid value for {name}: {value!r}")
+    if not np.isfinite(number):
+        raise ValueError(f"Invalid value for {name}: {value!r}")
+    if name in _INT_PARAMS:
+        if not number.is_integer():
+            raise ValueError(f"{name} must be a whole number, got {value!r}")
+        value = int(number)
+    else:
+        value = number
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    return value
+
+
+# Defaults overridden by any known keys in overrides (a dict or request args);
+# unknown keys are ignored so it can be fed a whole query string
+def analysis_params(overrides=None):
+    if overrides is not None and not hasattr(overrides, "items"):
+        raise ValueError("Analysis parameters must be an object of name: value pairs")
+    params = dict(DEFAULT_ANALYSIS_PARAMS)
+    for name, value in (overrides or {}).items():
+        if name in DEFAULT_ANALYSIS_PARAMS and value not in (None, ""):
+            params[name] = _coerce_param(name, value)
+
+    if params["buffer"] <= 0 or params["scale"] <= 0:
+        raise ValueError("buffer and scale must be positive")
+    if params["canny_low"] > params["canny_high"]:
+        raise ValueError("canny_low must not exceed canny_high")
+    if params["moderate_cutoff"] > params["diseased_cutoff"]:
+        raise ValueError("moderate_cutoff must not exceed diseased_cutoff")
+    return params
+
+
+# Non-default parameters as a stable string ("{}" for the defaults); labels
+# rows in data/pest_scores.csv so scores from different settings aren't mixed
+def params_label(params):
+    return json.dumps({name: value for name, value in params.items()
+                       if value != DEFAULT_ANALYSIS_PARAMS[name]}, sort_keys=True)
+
+
+# Edge + Laplacian pest detection; returns the detection image and the
+# percentage of pixels flagged as diseased
+def detect_pests(image_np, params=None):
+    params = params or DEFAULT_ANALYSIS_PARAMS
+
+    # Apply Canny Edge Detection
+    edges = cv2.Canny(image_np, threshold1=params["canny_low"], threshold2=params["canny_high"])
+
+    # Apply Laplacian (Delight Filter)
+    laplacian = _laplacian(image_np)
+
+    # Combine Edge Detection & Laplacian for Pest Detection
+    pest_detection = cv2.addWeighted(edges, params["edge_weight"], laplacian, params["laplacian_weight"], 0)
+
+    # Calculate Pest Affected Percentage
+    total_pixels = pest_detection.size
+    diseased_pixels = np.sum(pest_detection > params["pixel_threshold"])
+    pest_density = (diseased_pixels / total_pixels) * 100
+    return pest_detection, pest_density
+
+
+def _laplacian(image_np):
+    laplacian = cv2.Laplacian(image_np, cv2.CV_64F)
+    return np.uint8(np.absolute(laplacian))
+
+
+# Categorize Pest Infection
+def classify_pest_density(pest_density, params=None):
+    params = params or DEFAULT_ANALYSIS_PARAMS
+    if pest_density < params["moderate_cutoff"]:
+        return "Healthy", "green"
+    elif pest_density < params["diseased_cutoff"]:
+        return "Moderate", "yellow"
+    return "Diseased", "red"
+
+
+# Pest data entry as stored in pest_data_dict and sent to the D3.js chart
+def pest_summary(lat, lon, pest_density, params=None):
+    status, color = classify_pest_density(pest_density, params)
+    return {
+        "lat": lat, "lon": lon,
+        "diseased_area": round(float(pest_density), 2),
+        "healthy_area": round(float(100 - pest_density), 2),
+        "status": status,
+        "color": color
+    }
+
+
+# Evaluate many parameter combinations over one raster.
+# grid maps parameter names to lists of values (missing names use base
+# params); returns one {params..., diseased_area, healthy_area, status} per
+# combination. Canny runs once per distinct threshold pair, the Laplacian
+# once overall; blending is broadcast over all weight pairs and every pixel
+# threshold is answered from one 256-bin histogram per blended image.
+def sweep_pest_params(image_np, grid, base_params=None):
+    base = analysis_params(base_params)
+    values = {}
+    for name, default in base.items():
+        if name in RASTER_PARAMS:
+            if name in grid:
+                raise ValueError(f"{name} changes the raster and can't be swept; run one sweep per raster")
+            continue
+        options = grid.get(name, [default])
+        if not isinstance(options, (list, tuple)) or not options:
+            raise ValueError(f"Sweep values for {name} must be a non-empty list")
+        values[name] = [_coerce_param(name, option) for option in options]
+    unknown = set(grid) - set(DEFAULT_ANALYSIS_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown analysis parameter(s): {', '.join(sorted(unknown))}")
+
+    canny_pairs = [(low, high) for low in values["canny_low"] for high in values["canny_high"] if low <= high]
+    weight_pairs = [(e, l) for e in values["edge_weight"] for l in values["laplacian_weight"]]
+    cutoff_pairs = [(m, d) for m in values["moderate_cutoff"] for d in values["diseased_cutoff"] if m <= d]
+    thresholds = np.array(values["pixel_threshold"])
+    combinations = len(canny_pairs) * len(weight_pairs) * len(thresholds) * len(cutoff_pairs)
+    if combinations == 0:
+        raise ValueError("Sweep has no valid combinations (check canny_low <= canny_high and cutoffs)")
+    if combinations > MAX_SWEEP_COMBINATIONS:
+        raise ValueError(f"Sweep has {combinations} combinations, limit is {MAX_SWEEP_COMBINATIONS}")
+
+    laplacian = _laplacian(image_np).astype(np.float32)
+    total_pixels = image_np.size
+    edge_weights = np.array([e for e, _ in weight_pairs], dtype=np.float32)[:, None, None]
+    laplacian_weights = np.array([l for _, l in weight_pairs], dtype=np.float32)[:, None, None]
+    moderate = np.array([m for m, _ in cutoff_pairs])
+    diseased = np.array([d for _, d in cutoff_pairs])
+    pixel_thresholds = np.clip(thresholds, 0, 255)  # Nothing exceeds 255 anyway
+
+    results = []
+    for low, high in canny_pairs:
+        edges = cv2.Canny(image_np, threshold1=low, threshold2=high).astype(np.float32)
+
+        # Same rounding/saturation as cv2.addWeighted, for all weight pairs at once
+        blended = np.clip(np.rint(edges[None] * edge_weights + laplacian[None] * laplacian_weights), 0, 255)
+        blended = blended.astype(np.int64).reshape(len(weight_pairs), -1)
+
+        # Pixels above each threshold = total - cumulative histogram up to it
+        offsets = np.arange(len(weight_pairs))[:, None] * 256
+        hist = np.bincount((blended + offsets).ravel(), minlength=256 * len(weight_pairs))
+        cumulative = hist.reshape(len(weight_pairs), 256).cumsum(axis=1)
+        above = total_pixels - cumulative[:, pixel_thresholds]
+        densities = above / total_pixels * 100          # (weight pairs, thresholds)
+
+        statuses = np.where(densities[..., None] < moderate, "Healthy",
+                            np.where(densities[..., None] < diseased, "Moderate", "Diseased"))
+
+        for w, (edge_weight, laplacian_weight) in enumerate(weight_pairs):
+            for t, pixel_threshold in enumerate(thresholds):
+                density = float(densities[w, t])
+                for c, (moderate_cutoff, diseased_cutoff) in enumerate(cutoff_pairs):
+                    results.append({
+                        "canny_low": low, "canny_high": high,
+                        "edge_weight": edge_weight, "laplacian_weight": laplacian_weight,
+                        "pixel_threshold": int(pixel_threshold),
+                        "moderate_cutoff": moderate_cutoff, "diseased_cutoff": diseased_cutoff,
+                        "diseased_area": round(density, 2),
+                        "healthy_area": round(100 - density, 2),
+                        "status": str(statuses[w, t, c]),
+                    })
+    return results
+
+
+# Whole CPU stage in one call (used from the process pool): plot (unless
+# render_plot is False, e.g. when the plot is already cached), detect pests
+# and save the pest image. Returns (ndvi_png_bytes or None, pest summary).
+def analyze_ndvi(image_np, lat, lon, pest_image_path, params=None, render_plot=True):
+    ndvi_png = render_ndvi_png(image_np, lat, lon).getvalue() if render_plot else None
+    pest_detection, pest_density = detect_pests(image_np, params)
+    cv2.imwrite(pest_image_path, pest_detection)
+    return ndvi_png, pest_summary(lat, lon, pest_density, params)
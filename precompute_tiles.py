@@ -0,0 +1,299 @@
+# Offline job: precompute NDVI and pest-density tile pyramids per country
+#   python precompute_tiles.py --window 2021-01-01:2021-12-31 --max-zoom 11
+#
+# For every country in the dataset (ap.csv_files plus ingested inventories) it takes the bounding box of that
+# country's CSV points, downloads a least-cloudy Sentinel-2 NDVI mosaic for
+# each date window, runs the same edge/Laplacian pest detection as the
+# dashboard, and writes both layers as XYZ PNG tiles under static/tiles/.
+# create_map() picks them up from static/tiles/index.json and overlays them
+# on the Folium map, so browsing a region needs no live Earth Engine calls.
+import argparse
+import json
+import math
+import os
+
+import ee
+import numpy as np
+from matplotlib import colormaps
+from PIL import Image
+
+import ap
+import ndvi_analysis
+
+TILES_DIR = os.path.join("static", "tiles")
+TILES_INDEX_PATH = os.path.join(TILES_DIR, "index.json")
+RASTER_DIR = os.path.join("data", "rasters")
+TILE_SIZE = 256
+
+# Largest chunk requested from getDownloadURL in one go (pixels per side)
+CHUNK_PIXELS = 2048
+# Pest density is the share of flagged pixels in blocks of this many pixels
+PEST_BLOCK = 16
+# Pest density at which the heatmap is fully red (%)
+PEST_DENSITY_MAX = 50
+
+NDVI_COLORMAP = colormaps["RdYlGn"]
+PEST_COLORMAP = colormaps["RdYlGn_r"]
+
+
+# Bounding box (west, south, east, north) of one country's CSV points
+def country_bbox(country, pad_deg):
+    points = ap.df[ap.df["country"] == country]
+    if points.empty:
+        return None
+    return (
+        float(points["LONGITUD"].min()) - pad_deg,
+        float(points["LATITUD"].min()) - pad_deg,
+        float(points["LONGITUD"].max()) + pad_deg,
+        float(points["LATITUD"].max()) + pad_deg,
+    )
+
+
+# Least-cloudy-on-top Sentinel-2 NDVI mosaic, scaled to 0-255 like the dashboard
+def ndvi_mosaic(region, start_date, end_date):
+    collection = (ee.ImageCollection("COPERNICUS/S2")
+                  .filterBounds(region)
+                  .filterDate(start_date, end_date)
+                  .sort("CLOUD_COVERAGE_ASSESSMENT", False))
+    mosaic = collection.mosaic()
+    NDVI = mosaic.normalizedDifference(["B8", "B4"])
+    return NDVI.multiply(255).toByte()
+
+
+# Download the NDVI mosaic over bbox as one (height, width) uint8 array in
+# EPSG:4326, in chunks small enough for getDownloadURL
+def download_ndvi_raster(bbox, start_date, end_date, max_pixels):
+    west, south, east, north = bbox
+    aspect = (east - west) / (north - south)
+    if aspect >= 1:
+        width, height = max_pixels, max(1, int(max_pixels / aspect))
+    else:
+        width, height = max(1, int(max_pixels * aspect)), max_pixels
+
+    image = ndvi_mosaic(ee.Geometry.Rectangle([west, south, east, north], "EPSG:4326", False),
+                        start_date, end_date)
+    raster = np.zeros((height, width), dtype=np.uint8)
+    deg_per_px_x = (east - west) / width
+    deg_per_px_y = (north - south) / height
+
+    for row in range(0, height, CHUNK_PIXELS):
+        for col in range(0, width, CHUNK_PIXELS):
+            chunk_h = min(CHUNK_PIXELS, height - row)
+            chunk_w = min(CHUNK_PIXELS, width - col)
+            chunk_west = west + col * deg_per_px_x
+            chunk_north = north - row * deg_per_px_y
+            chunk_region = ee.Geometry.Rectangle(
+                [chunk_west, chunk_north - chunk_h * deg_per_px_y, chunk_west + chunk_w * deg_per_px_x, chunk_north],
+                "EPSG:4326", False)
+            try:
+                url = image.getDownloadURL({
+                    "region": chunk_region,
+                    "dimensions": f"{chunk_w}x{chunk_h}",
+                    "crs": "EPSG:4326",
+                    "format": "GeoTIFF"
+                })
+                chunk = ndvi_analysis.decode_ndvi_geotiff(ap.download_ndvi_bytes(url))
+            except Exception as e:
+                print(f"⚠️ Chunk at row {row}, col {col} failed: {e}")
+                continue
+
+            # EE may round the grid by a pixel; snap back to the requested size
+            if chunk.shape != (chunk_h, chunk_w):
+                chunk = np.array(Image.fromarray(chunk).resize((chunk_w, chunk_h), Image.NEAREST))
+            raster[row:row + chunk_h, col:col + chunk_w] = chunk
+
+    return raster
+
+
+# Pest density (% of flagged pixels) per PEST_BLOCK x PEST_BLOCK block of
+# the NDVI raster, flagged with detect_pests' own pixel_threshold and counted
+# over valid pixels only (masked pixels are neither flagged nor counted).
+# When the raster size isn't a multiple of PEST_BLOCK the last row/column of
+# blocks is partial: they extend past the bbox and their density is over the
+# real pixels only (see pest_extent for sampling them). Blocks without any
+# valid pixel read 0; the tiles mask them out anyway.
+def pest_density_raster(ndvi_raster, valid=None, params=None):
+    params = params or ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    pest_detection, _ = ndvi_analysis.detect_pests(ndvi_raster, params)
+    if valid is None:
+        valid = np.ones(ndvi_raster.shape, dtype=bool)
+    flagged = ((pest_detection > params["pixel_threshold"]) & valid).astype(np.float32)
+
+    height, width = flagged.shape
+    pad = ((0, (-height) % PEST_BLOCK), (0, (-width) % PEST_BLOCK))
+    flagged = np.pad(flagged, pad)
+    real = np.pad(valid.astype(np.float32), pad)
+
+    def block_sums(array):
+        blocks = array.reshape(array.shape[0] // PEST_BLOCK, PEST_BLOCK, array.shape[1] // PEST_BLOCK, PEST_BLOCK)
+        return blocks.sum(axis=(1, 3))
+
+    flagged_sums, real_sums = block_sums(flagged), block_sums(real)
+    return np.divide(flagged_sums, real_sums, out=np.zeros_like(flagged_sums), where=real_sums > 0) * 100
+
+
+# Rows / columns of the pest grid spanned by the bbox (fractional for a partial last block)
+def pest_extent(ndvi_shape):
+    return ndvi_shape[0] / PEST_BLOCK, ndvi_shape[1] / PEST_BLOCK
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    n = 2 ** zoom
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return int(min(max(x, 0), n - 1)), int(min(max(y, 0), n - 1))
+
+
+# Longitudes of the pixel-column centres and latitudes of the pixel-row
+# centres of one web-mercator tile
+def tile_pixel_coords(x, y, zoom):
+    n = 2 ** zoom
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lons = (x + offsets) / n * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    return lons, lats
+
+
+# Nearest-neighbour (rows, cols) index grids into an array, for fractional
+# positions fy (rows, 0 = north) and fx (cols, 0 = west) within the bbox.
+# extent is how many rows / columns of the array the bbox spans (default:
+# all of them; less when the array's last cells run past the bbox).
+def sample_indices(shape, fy, fx, extent=None):
+    height, width = shape
+    extent_h, extent_w = extent or shape
+    rows = np.clip(np.floor(fy * extent_h).astype(int), 0, height - 1)[:, None]
+    cols = np.clip(np.floor(fx * extent_w).astype(int), 0, width - 1)[None, :]
+    return rows, cols
+
+
+# Write one layer as an XYZ tile pyramid. values is a 2D array over bbox
+# (any resolution; values_extent as in sample_indices), valid a boolean mask
+# exactly covering bbox, and to_rgba maps values to RGBA floats.
+def write_tile_pyramid(values, valid, bbox, to_rgba, out_dir, min_zoom, max_zoom, values_extent=None):
+    west, south, east, north = bbox
+    written = 0
+
+    for zoom in range(min_zoom, max_zoom + 1):
+        x_min, y_min = lonlat_to_tile(west, north, zoom)
+        x_max, y_max = lonlat_to_tile(east, south, zoom)
+
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                lons, lats = tile_pixel_coords(x, y, zoom)
+                fx = (lons - west) / (east - west)
+                fy = (north - lats) / (north - south)
+                inside = ((fy >= 0) & (fy < 1))[:, None] & ((fx >= 0) & (fx < 1))[None, :]
+                if not inside.any():
+                    continue
+
+                mask = inside & valid[sample_indices(valid.shape, fy, fx)]
+                if not mask.any():
+                    continue
+
+                rgba = (to_rgba(values[sample_indices(values.shape, fy, fx, values_extent)]) * 255).astype(np.uint8)
+                rgba[..., 3] = np.where(mask, 180, 0)  # Semi-transparent overlay
+
+                tile_dir = os.path.join(out_dir, str(zoom), str(x))
+                os.makedirs(tile_dir, exist_ok=True)
+                Image.fromarray(rgba, "RGBA").save(os.path.join(tile_dir, f"{y}.png"), optimize=True)
+                written += 1
+
+    return written
+
+
+def load_tiles_index():
+    if os.path.exists(TILES_INDEX_PATH):
+        with open(TILES_INDEX_PATH, "r", encoding="utf-8") as file:
+            return json.load(file)
+    return {"layers": []}
+
+
+def save_tiles_index(index):
+    os.makedirs(TILES_DIR, exist_ok=True)
+    tmp_path = TILES_INDEX_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(index, file, indent=2)
+    os.replace(tmp_path, TILES_INDEX_PATH)
+
+
+def register_layer(index, layer):
+    index["layers"] = [
+        existing for existing in index["layers"]
+        if (existing["layer"], existing["country"], existing["window"]) != (layer["layer"], layer["country"], layer["window"])
+    ]
+    index["layers"].append(layer)
+
+
+def precompute_country(country, start_date, end_date, args, index):
+    bbox = country_bbox(country, args.pad_deg)
+    if bbox is None:
+        print(f"⚠️ No points for {country}, skipping")
+        return
+
+    window = f"{start_date}_{end_date}"
+    print(f"🛰️ {country} {window}: downloading NDVI mosaic over {bbox}")
+    ndvi_raster = download_ndvi_raster(bbox, start_date, end_date, args.max_pixels)
+    valid = ndvi_raster > 0  # Masked / non-vegetated pixels come back as 0
+
+    # Keep the base rasters so later jobs can reuse them without Earth Engine
+    raster_dir = os.path.join(RASTER_DIR, country, window)
+    os.makedirs(raster_dir, exist_ok=True)
+    pest_raster = pest_density_raster(ndvi_raster, valid)
+    np.savez_compressed(os.path.join(raster_dir, "rasters.npz"), ndvi=ndvi_raster,
+                        pest_density=pest_raster.astype(np.float32), pest_block=PEST_BLOCK, bbox=np.array(bbox))
+
+    layers = {
+        "ndvi": (ndvi_raster, None, lambda v: NDVI_COLORMAP(v / 255.0)),
+        "pest": (pest_raster, pest_extent(ndvi_raster.shape),
+                 lambda v: PEST_COLORMAP(np.clip(v / PEST_DENSITY_MAX, 0, 1))),
+    }
+    for layer, (values, extent, to_rgba) in layers.items():
+        out_dir = os.path.join(TILES_DIR, layer, country, window)
+        count = write_tile_pyramid(values, valid, bbox, to_rgba, out_dir, args.min_zoom, args.max_zoom, extent)
+        print(f"✅ {country} {layer}: {count} tiles written to {out_dir}")
+
+        register_layer(index, {
+            "layer": layer, "country": country, "window": window,
+            "start_date": start_date, "end_date": end_date,
+            "bbox": list(bbox), "min_zoom": args.min_zoom, "max_zoom": args.max_zoom,
+            "url": "/" + "/".join([TILES_DIR.replace(os.sep, "/"), layer, country, window]) + "/{z}/{x}/{y}.png",
+        })
+        save_tiles_index(index)
+
+
+def parse_window(value):
+    start_date, _, end_date = value.partition(":")
+    if not start_date or not end_date:
+        raise argparse.ArgumentTypeError("window must look like YYYY-MM-DD:YYYY-MM-DD")
+    return start_date, end_date
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute NDVI and pest-density tile pyramids per country")
+    countries = sorted(ap.df["country"].unique())
+    parser.add_argument("--country", action="append", choices=countries,
+                        help="Country to process (repeatable, default: all)")
+    parser.add_argument("--window", action="append", type=parse_window,
+                        help="Date window START:END (repeatable, default: 2021-01-01:2021-12-31)")
+    parser.add_argument("--min-zoom", type=int, default=5)
+    parser.add_argument("--max-zoom", type=int, default=11)
+    parser.add_argument("--max-pixels", type=int, default=8192,
+                        help="Longest side of the downloaded NDVI raster per country")
+    parser.add_argument("--pad-deg", type=float, default=0.05,
+                        help="Padding added around the points' bounding box (degrees)")
+    args = parser.parse_args()
+
+    countries = args.country or countries
+    windows = args.window or [("2021-01-01", "2021-12-31")]
+    index = load_tiles_index()
+
+    for country in countries:
+        for start_date, end_date in windows:
+            try:
+                precompute_country(country, start_date, end_date, args, index)
+            except Exception as e:
+                print(f"❌ Error precomputing {country} {start_date}:{end_date}: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Background job: run the pest detection for every farm in the CSV dataset
+#   python score_points.py --start-date 2021-01-01 --end-date 2021-12-31 --workers 4 --rate 2
+#   python score_points.py --param pixel_threshold=80 --param diseased_cutoff=25
+#
+# Results are appended to data/pest_scores.csv (LATITUD, LONGITUD,
+# diseased_area, healthy_area, pest_status, ...) and joined onto ap.df, so the
+# dashboard can colour and filter markers by health without Earth Engine.
+# The checkpoint file makes the job resumable: points already scored for the
+# same date window and parameters are skipped on the next run.
+import argparse
+import csv
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import ap
+import ndvi_analysis
+
+SCORE_COLUMNS = ["LATITUD", "LONGITUD", "start_date", "end_date",
+                 "diseased_area", "healthy_area", "pest_status", "scored_at", "params"]
+
+
+# Simple shared rate limiter: at most `rate` Earth Engine lookups per second
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+# Points already in the checkpoint for this date window and parameter set
+def load_done(checkpoint_path, start_date, end_date, label):
+    done = set()
+    if not os.path.exists(checkpoint_path):
+        return done
+
+    with open(checkpoint_path, "r", newline="", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            if (row["start_date"] == start_date and row["end_date"] == end_date
+                    and (row.get("params") or "{}") == label):
+                done.add((float(row["LATITUD"]), float(row["LONGITUD"])))
+    return done
+
+
+# Pest score for one point (same logic as generate_ndvi_plot, minus the plot and image).
+# The raster goes through ap's caches, so re-scoring with new thresholds is cheap.
+def score_point(lat, lon, start_date, end_date, params, limiter):
+    key = ap.raster_key(lat, lon, start_date, end_date, params)
+    if ap.ndvi_array_get(key) is None:
+        limiter.wait()  # Only Earth Engine lookups count against the rate limit
+    image_np = ap.fetch_ndvi_array(lat, lon, start_date, end_date, params)
+    _, pest_density = ndvi_analysis.detect_pests(image_np, params)
+    return ndvi_analysis.pest_summary(lat, lon, pest_density, params)
+
+
+# Checkpoints started before scores recorded their parameters have no params
+# column; rewrite them in the current layout (their rows were all scored with
+# the defaults) so new rows keep their label instead of losing it.
+def migrate_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return
+    with open(checkpoint_path, "r", newline="", encoding="utf-8") as file:
+        reader = csv.DictReader(file)
+        if reader.fieldnames is None or reader.fieldnames == SCORE_COLUMNS:
+            return
+        if not set(reader.fieldnames) <= set(SCORE_COLUMNS):
+            raise SystemExit(f"❌ {checkpoint_path} has unexpected columns: {', '.join(reader.fieldnames)}")
+
+        tmp_path = f"{checkpoint_path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as out:
+            writer = csv.DictWriter(out, fieldnames=SCORE_COLUMNS)
+            writer.writeheader()
+            for row in reader:
+                row["params"] = row.get("params") or "{}"
+                writer.writerow(row)
+    os.replace(tmp_path, checkpoint_path)
+    print(f"🔧 Migrated {checkpoint_path} to the current column layout")
+
+
+def parse_param(value):
+    name, _, raw = value.partition("=")
+    if name not in ndvi_analysis.DEFAULT_ANALYSIS_PARAMS:
+        raise argparse.ArgumentTypeError(
+            f"unknown parameter {name!r} (one of {', '.join(ndvi_analysis.DEFAULT_ANALYSIS_PARAMS)})")
+    return name, raw
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score pest density for every point in the CSV dataset")
+    parser.add_argument("--start-date", default="2021-01-01")
+    parser.add_argument("--end-date", default="2021-12-31")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent Earth Engine lookups")
+    parser.add_argument("--rate", type=float, default=2.0, help="Max lookups per second (0 = unlimited)")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many new points")
+    parser.add_argument("--param", action="append", type=parse_param, default=[],
+                        help="Analysis parameter override NAME=VALUE, e.g. pixel_threshold=80 (repeatable)")
+    parser.add_argument("--checkpoint", default=ap.PEST_SCORES_PATH)
+    args = parser.parse_args()
+
+    try:
+        params = ndvi_analysis.analysis_params(dict(args.param))
+    except ValueError as e:
+        parser.error(str(e))
+    label = ndvi_analysis.params_label(params)
+
+    points = ap.df[["LATITUD", "LONGITUD"]].drop_duplicates()
+    done = load_done(args.checkpoint, args.start_date, args.end_date, label)
+    todo = [(lat, lon) for lat, lon in points.itertuples(index=False) if (lat, lon) not in done]
+    if args.limit is not None:
+        todo = todo[:args.limit]
+    print(f"🐛 {len(done)} points already scored, {len(todo)} to go")
+
+    os.makedirs(os.path.dirname(args.checkpoint) or ".", exist_ok=True)
+    migrate_checkpoint(args.checkpoint)
+    write_header = not os.path.exists(args.checkpoint) or os.path.getsize(args.checkpoint) == 0
+    limiter = RateLimiter(args.rate)
+    scored, failed = 0, 0
+
+    with open(args.checkpoint, "a", newline="", encoding="utf-8") as file, \
+            ThreadPoolExecutor(max_workers=args.workers) as executor:
+        writer = csv.DictWriter(file, fieldnames=SCORE_COLUMNS)
+        if write_header:
+            writer.writeheader()
+
+        futures = {
+            executor.submit(score_point, lat, lon, args.start_date, args.end_date, params, limiter): (lat, lon)
+            for lat, lon in todo
+        }
+        for future in as_completed(futures):
+            lat, lon = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"⚠️ Scoring failed for {lat},{lon}: {e}")
+                continue
+
+            writer.writerow({
+                "LATITUD": lat, "LONGITUD": lon,
+                "start_date": args.start_date, "end_date": args.end_date,
+                "diseased_area": summary["diseased_area"],
+                "healthy_area": summary["healthy_area"],
+                "pest_status": summary["status"],
+                "scored_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "params": label,
+            })
+            # Flush every row so an interrupted run loses nothing already scored
+            file.flush()
+            scored += 1
+            if scored % 50 == 0:
+                print(f"✅ {scored}/{len(todo)} scored ({failed} failed)")
+
+    print(f"✅ Done: {scored} scored, {failed} failed (failed points are retried on the next run)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# Data shared between worker processes through memory-mapped files, so that
+# a result computed by one worker is a cache hit in every other one and the
+# shared cache costs one fixed-size file however many workers there are.
+#
+#   PointStore - read-only per-point country / product codes as .npy files
+#                opened with mmap_mode="r" (zero-copy in every worker), for the
+#                unfiltered dashboard counts. Markers, filters, /api/points and
+#                exports still use each worker's own ap.df.
+#   SlotCache  - fixed-size key/value cache in one mmap'd file, used for NDVI
+#                images, raw NDVI rasters and pest summaries
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR", "cache")
+POINTS_DIR = os.path.join(SHARED_CACHE_DIR, "points")
+
+
+# ---------------------- POINT ARRAYS ---------------------- #
+
+# Write df's country / product codes as .npy files plus a small JSON index.
+# Written to a temp dir and swapped in, so readers never see half a store;
+# the lock file makes workers republishing at the same time take turns.
+def publish_points(df, product_column, directory=POINTS_DIR):
+    country_codes, country_names = _encode(df["country"])
+    if product_column:
+        product_codes, product_names = _encode(df[product_column])
+    else:
+        product_codes, product_names = np.full(len(df), -1, dtype=np.int32), []
+
+    digest = hashlib.sha1()
+    for array in (country_codes, product_codes):
+        digest.update(array.tobytes())
+    digest.update(json.dumps([country_names, product_names]).encode("utf-8"))
+    version = digest.hexdigest()
+
+    with _store_lock(directory, fcntl.LOCK_EX):
+        existing = _read_index(directory)
+        if existing is not None and existing["version"] == version:
+            return version
+
+        tmp_dir = f"{directory}.tmp{os.getpid()}"
+        old_dir = f"{directory}.old{os.getpid()}"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            np.save(os.path.join(tmp_dir, "country_code.npy"), country_codes.astype(np.int16))
+            np.save(os.path.join(tmp_dir, "product_code.npy"), product_codes.astype(np.int32))
+            with open(os.path.join(tmp_dir, "index.json"), "w", encoding="utf-8") as file:
+                json.dump({"version": version, "rows": len(df), "countries": country_names,
+                           "products": product_names}, file)
+
+            if os.path.exists(directory):
+                os.replace(directory, old_dir)
+            os.replace(tmp_dir, directory)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(old_dir, ignore_errors=True)
+    return version
+
+
+# flock on <directory>.lock: exclusive for publishing, shared for opening a store.
+# flock (unlike lockf) also excludes other threads of the same process.
+@contextmanager
+def _store_lock(directory, mode):
+    os.makedirs(os.path.dirname(directory) or ".", exist_ok=True)
+    with open(f"{directory}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Category codes (int32, -1 for missing) and the names they index into
+def _encode(series):
+    codes, names = series.factorize(sort=True)
+    return codes.astype(np.int32), [str(name) for name in names]
+
+
+def _read_index(directory):
+    try:
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+class PointStore:
+    def __init__(self, directory=POINTS_DIR):
+        self.directory = directory
+
+        def load(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+        # Shared lock: never open a store halfway through being swapped
+        with _store_lock(directory, fcntl.LOCK_SH):
+            self.index = _read_index(directory)
+            if self.index is None:
+                raise FileNotFoundError(f"No point store in {directory}")
+            self.country_code = load("country_code")
+            self.product_code = load("product_code")
+        self.countries = self.index["countries"]
+        self.products = self.index["products"]
+        self.version = self.index["version"]
+
+    def country_counts(self):
+        return self._counts(self.country_code, self.countries)
+
+    def product_counts(self):
+        return self._counts(self.product_code, self.products)
+
+    # {name: count}, largest first, like Series.value_counts()
+    @staticmethod
+    def _counts(codes, names):
+        valid = codes[codes >= 0]
+        counts = np.bincount(valid, minlength=len(names)) if len(names) else np.array([], dtype=np.int64)
+        order = np.argsort(-counts, kind="stable")
+        return {names[i]: int(counts[i]) for i in order if counts[i] > 0}
+
+
+# ---------------------- SLOT CACHE ---------------------- #
+
+_MAGIC = b"NDVISLOT"
+_FILE_HEADER = struct.Struct("<8sII")        # magic, slot count, slot size
+_SLOT_HEADER = struct.Struct("<Q16sII")      # seq, key digest, length, crc32
+
+
+# Keys that compare equal must hash to the same slot: 10, 10.0 and
+# np.float64(10.0) all become 10 (numbers are floats unless integral)
+def _normalize_key(key):
+    if isinstance(key, (tuple, list)):
+        return tuple(_normalize_key(part) for part in key)
+    if isinstance(key, (int, float, np.integer, np.floating)) and not isinstance(key, bool):
+        number = float(key)
+        return int(number) if number.is_integer() else number
+    return key
+
+
+# Direct-mapped cache: a key's slot is chosen from its hash, and a newer
+# entry simply replaces whatever was in that slot. Each slot is guarded by
+# a sequence number (odd while being written) so readers in other processes
+# never return a torn value, and by a byte-range lock between writers.
+class SlotCache:
+    def __init__(self, path, slots=512, slot_size=512 * 1024):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        # First process to get here sizes and stamps the file
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, _FILE_HEADER.size, 0)
+        try:
+            header = os.pread(self.fd, _FILE_HEADER.size, 0)
+            if len(header) == _FILE_HEADER.size and header.startswith(_MAGIC):
+                _, slots, slot_size = _FILE_HEADER.unpack(header)
+            else:
+                os.ftruncate(self.fd, _FILE_HEADER.size + slots * slot_size)
+                os.pwrite(self.fd, _FILE_HEADER.pack(_MAGIC, slots, slot_size), 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, _FILE_HEADER.size, 0)
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_value_size = slot_size - _SLOT_HEADER.size
+        self.map = mmap.mmap(self.fd, _FILE_HEADER.size + slots * slot_size)
+        # lockf locks belong to the process, so gthread workers' threads would
+        # all "hold" the same slot lock; this serialises them within a process
+        self.write_lock = threading.Lock()
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.blake2b(repr(_normalize_key(key)).encode("utf-8"), digest_size=16).digest()
+
+    def _offset(self, digest):
+        return _FILE_HEADER.size + (int.from_bytes(digest[:8], "little") % self.slots) * self.slot_size
+
+    def get(self, key):
+        digest = self._digest(key)
+        offset = self._offset(digest)
+
+        seq, slot_digest, length, crc = _SLOT_HEADER.unpack_from(self.map, offset)
+        if seq % 2 or slot_digest != digest or length > self.max_value_size:
+            return None
+        start = offset + _SLOT_HEADER.size
+        value = self.map[start:start + length]
+
+        # Re-check the sequence number: if a writer got in meanwhile, treat as a miss
+        if _SLOT_HEADER.unpack_from(self.map, offset)[0] != seq or zlib.crc32(value) != crc:
+            return None
+        return value
+
+    # Returns False if the value is too big for a slot
+    def put(self, key, value):
+        if len(value) > self.max_value_size:
+            return False
+        digest = self._digest(key)
+        offset = self._offset(digest)
+
+        with self.write_lock:
+            self._write(offset, digest, value)
+        return True
+
+    # Caller holds write_lock; the slot's lockf range keeps other processes out
+    def _write(self, offset, digest, value):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot_size, offset)
+        try:
+            seq = _SLOT_HEADER.unpack_from(self.map, offset)[0]
+            seq += 1 if seq % 2 == 0 else 2  # Odd: write in progress
+            struct.pack_into("<Q", self.map, offset, seq)
+            start = offset + _SLOT_HEADER.size
+            self.map[start:start + len(value)] = value
+            _SLOT_HEADER.pack_into(self.map, offset, seq, digest, len(value), zlib.crc32(value))
+            struct.pack_into("<Q", self.map, offset, seq + 1)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def put_json(self, key, obj):
+        return self.put(key, json.dumps(obj).encode("utf-8"))
@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import export
+import ndvi_analysis
+
+START, END = "2021-01-01", "2021-12-31"
+CUSTOM = ndvi_analysis.analysis_params({"pixel_threshold": 80})
+
+
+# Just the parts of ap that export reads, backed by dicts
+class StubApp:
+    def __init__(self, tmp_path, pest_data=None, ndvi_images=None, ndvi_arrays=None):
+        self.PEST_SCORES_PATH = str(tmp_path / "pest_scores.csv")
+        self.pest_dir = tmp_path / "pest_images"
+        self.pest_dir.mkdir()
+        self.pest_data = pest_data or {}
+        self.ndvi_images = ndvi_images or {}
+        self.ndvi_arrays = ndvi_arrays or {}
+
+    def lookup_pest_data(self, lat, lon, start_date, end_date, params):
+        return self.pest_data.get((lat, lon, start_date, end_date, ndvi_analysis.params_label(params)))
+
+    def raster_key(self, lat, lon, start_date, end_date, params):
+        return lat, lon, start_date, end_date, ndvi_analysis.params_label(params)
+
+    def ndvi_cache_get(self, key):
+        return self.ndvi_images.get(key)
+
+    def ndvi_array_get(self, key):
+        return self.ndvi_arrays.get(key)
+
+    def pest_image_path_for(self, lat, lon):
+        return str(self.pest_dir / f"pest_{lat}_{lon}.png")
+
+
+def write_scores(app, rows):
+    with open(app.PEST_SCORES_PATH, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=["LATITUD", "LONGITUD", "start_date", "end_date", "diseased_area",
+                                                  "healthy_area", "pest_status", "scored_at", "params"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def score(lat, lon, diseased, scored_at, start=START, end=END, params="{}"):
+    return {"LATITUD": lat, "LONGITUD": lon, "start_date": start, "end_date": end, "diseased_area": diseased,
+            "healthy_area": 100 - diseased, "pest_status": "Moderate", "scored_at": scored_at, "params": params}
+
+
+def record(lat, lon, **fields):
+    return {**dict.fromkeys(export.RECORD_FIELDS), "lat": lat, "lon": lon, "country": "Peru", **fields}
+
+
+def test_score_lookup_filters_by_window_and_params(tmp_path):
+    app = StubApp(tmp_path)
+    custom = ndvi_analysis.params_label(CUSTOM)
+    write_scores(app, [
+        score(1.0, 2.0, 10, "2024-01-01T00:00:00"),
+        score(1.0, 2.0, 20, "2024-02-01T00:00:00"),                   # Latest for the default params
+        score(1.0, 2.0, 30, "2024-03-01T00:00:00", params=custom),
+        score(3.0, 4.0, 40, "2024-01-01T00:00:00", start="2020-01-01"),
+        score(5.0, 6.0, 50, "2024-01-01T00:00:00", params=""),        # Written before params were recorded
+    ])
+
+    default = export._score_lookup(app, START, END, ndvi_analysis.DEFAULT_ANALYSIS_PARAMS)
+    assert default == {(1.0, 2.0): (20, 80, "Moderate"), (5.0, 6.0): (50, 50, "Moderate")}
+    assert export._score_lookup(app, START, END, CUSTOM) == {(1.0, 2.0): (30, 70, "Moderate")}
+    assert export._score_lookup(app, "2020-01-01", END, CUSTOM) == {}
+
+
+def test_score_lookup_without_scores_file(tmp_path):
+    assert export._score_lookup(StubApp(tmp_path), START, END, CUSTOM) == {}
+
+
+def test_iter_records_prefers_matching_analysis_and_cached_rasters(tmp_path):
+    key = (1.0, 2.0, START, END, "{}")
+    app = StubApp(tmp_path, pest_data={key: {"diseased_area": 12.5, "healthy_area": 87.5, "status": "Moderate"}},
+                  ndvi_images={key: {"png": b"png"}}, ndvi_arrays={key: np.full((4, 4), 255, dtype=np.uint8)})
+    write_scores(app, [score(1.0, 2.0, 60, "2024-01-01T00:00:00"), score(3.0, 4.0, 40, "2024-01-01T00:00:00")])
+    (app.pest_dir / "pest_1.0_2.0.png").write_bytes(b"pest")
+    (app.pest_dir / "pest_3.0_4.0.png").write_bytes(b"pest")
+
+    analysed, scored = export.iter_records(app, [(1.0, 2.0, "Peru"), (3.0, 4.0, None)], START, END)
+    assert (analysed["diseased_area"], analysed["source"], analysed["ndvi_mean"]) == (12.5, "analysis", 1.0)
+    assert analysed["has_ndvi_image"] and analysed["has_pest_image"]
+    assert (scored["diseased_area"], scored["source"], scored["ndvi_mean"]) == (40, "score", None)
+    # Its pest image comes from some other analysis, not this window / params
+    assert not scored["has_ndvi_image"] and not scored["has_pest_image"]
+
+
+def test_stream_csv_chunks_and_roundtrip(monkeypatch):
+    monkeypatch.setattr(export, "STREAM_CHUNK_SIZE", 256)
+    records = [record(float(i), -float(i), status="Healthy") for i in range(50)]
+    chunks = list(export.stream_csv(iter(records)))
+
+    assert len(chunks) > 1
+    rows = list(csv.DictReader(io.StringIO(b"".join(chunks).decode("utf-8"))))
+    assert len(rows) == 50
+    assert rows[7]["lat"] == "7.0" and rows[7]["status"] == "Healthy" and rows[7]["diseased_area"] == ""
+
+
+@pytest.mark.parametrize("count", [0, 1, 3])
+def test_stream_geojson_is_valid(count):
+    records = [record(float(i), -float(i), diseased_area=1.5) for i in range(count)]
+    collection = json.loads(b"".join(export.stream_geojson(iter(records))))
+
+    assert collection["type"] == "FeatureCollection"
+    assert len(collection["features"]) == count
+    for i, feature in enumerate(collection["features"]):
+        assert feature["geometry"]["coordinates"] == [-float(i), float(i)]
+        assert "lat" not in feature["properties"] and feature["properties"]["diseased_area"] == 1.5
+
+
+def test_chunk_sink_builds_a_readable_zip():
+    sink = export._ChunkSink()
+    chunks = []
+    with zipfile.ZipFile(sink, "w") as archive:
+        for i in range(3):
+            archive.writestr(f"file{i}.txt", f"content {i}" * 100)
+            chunks.append(sink.drain())
+    chunks.append(sink.drain())
+
+    assert all(chunks[:3]) and sink.tell() == sum(map(len, chunks))
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert archive.read("file2.txt") == b"content 2" * 100
+
+
+def test_stream_zip_has_images_and_summary(tmp_path):
+    key = (1.0, 2.0, START, END, "{}")
+    app = StubApp(tmp_path, ndvi_images={key: {"png": b"ndvi png"}})
+    (app.pest_dir / "pest_1.0_2.0.png").write_bytes(b"pest png")
+    records = [record(1.0, 2.0, has_ndvi_image=True, has_pest_image=True),
+               record(3.0, 4.0, has_ndvi_image=False, has_pest_image=False)]
+
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(export.stream_zip(app, iter(records), START, END))))
+    assert sorted(archive.namelist()) == ["ndvi_1.0_2.0.png", "pest_1.0_2.0.png", "summary.csv"]
+    assert archive.read("pest_1.0_2.0.png") == b"pest png"
+    assert archive.getinfo("summary.csv").compress_type == zipfile.ZIP_DEFLATED
+    summary = pd.read_csv(io.BytesIO(archive.read("summary.csv")))
+    assert summary[["lat", "lon"]].values.tolist() == [[1.0, 2.0], [3.0, 4.0]]
+
+
+def test_generate_export_rejects_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        export.generate_export(StubApp(tmp_path), "xlsx", [], START, END)
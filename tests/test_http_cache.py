@@ -0,0 +1,78 @@
+import io
+
+import pytest
+from PIL import Image
+
+import http_cache
+
+ALL_FORMATS = ["avif", "webp", "png"]
+CHROME_IMG_ACCEPT = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (CHROME_IMG_ACCEPT, "avif"),
+    ("image/webp,*/*", "webp"),
+    ("image/avif;q=0,image/webp", "webp"),
+    ("*/*", "png"),             # Wildcards alone never pick a newer format
+    ("image/*", "png"),
+    ("", "png"),
+    (None, "png"),
+])
+def test_choose_image_format(accept, expected):
+    assert http_cache.choose_image_format(accept, ALL_FORMATS) == expected
+
+
+def test_lossless_formats_never_include_avif():
+    assert "avif" not in http_cache.LOSSLESS_FORMATS
+    assert http_cache.LOSSLESS_FORMATS[-1] == "png"
+    assert http_cache.choose_image_format(CHROME_IMG_ACCEPT, ["webp", "png"]) == "webp"
+
+
+@pytest.mark.parametrize("header, matches", [
+    ('"abc-png"', True),
+    ('W/"abc-png"', True),
+    ('"other", "abc-png"', True),
+    ("*", True),
+    ('"abc-webp"', False),
+    ("", False),
+    (None, False),
+])
+def test_etag_matches(header, matches):
+    assert http_cache.etag_matches(header, "abc-png") is matches
+
+
+def _png_entry():
+    out = io.BytesIO()
+    Image.new("L", (4, 4), 128).save(out, format="PNG")
+    png = out.getvalue()
+    return {"png": png, "etag": http_cache.content_etag(png), "variants": {}}
+
+
+def test_image_response_parts_conditional_get():
+    entry = _png_entry()
+    status, body, mimetype, headers = http_cache.image_response_parts(entry, "*/*", None, immutable=True)
+    assert (status, body, mimetype) == (200, entry["png"], "image/png")
+    assert headers["ETag"] == f'"{entry["etag"]}-png"'
+    assert "immutable" in headers["Cache-Control"]
+    assert headers["Vary"] == "Accept"
+
+    status, body, _, headers = http_cache.image_response_parts(entry, "*/*", headers["ETag"], immutable=False)
+    assert (status, body) == (304, b"")
+    assert headers["Cache-Control"] == "public, no-cache"
+
+
+def test_image_response_parts_respects_entry_formats():
+    entry = {**_png_entry(), "formats": ["png"]}
+    status, _, mimetype, _ = http_cache.image_response_parts(entry, CHROME_IMG_ACCEPT, None, immutable=False)
+    assert (status, mimetype) == (200, "image/png")
+
+
+@pytest.mark.skipif("webp" not in http_cache.PREFERRED_FORMATS, reason="Pillow built without WebP")
+def test_webp_variant_is_lossless():
+    gradient = Image.new("L", (64, 64))
+    gradient.putdata([(x * 4 + y) % 256 for y in range(64) for x in range(64)])
+    out = io.BytesIO()
+    gradient.save(out, format="PNG")
+
+    webp = http_cache.encode_variant(out.getvalue(), "webp")
+    assert Image.open(io.BytesIO(webp)).convert("L").tobytes() == gradient.tobytes()
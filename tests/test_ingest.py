@@ -0,0 +1,110 @@
+import io
+import json
+
+import pandas as pd
+import pytest
+
+import ingest
+
+PRODUCT = "PRODUCTO/CULTIVO"
+
+
+def test_normalize_chunk_aliases_decimal_commas_and_products():
+    chunk = pd.DataFrame({
+        "Latitude": ["-12,05", " -13.5 ", "x"],
+        "lng": ["-77,04", "-71.9", "-70"],
+        "Producto": [" Cacao ", "Café", "Maíz"],
+    })
+    rows, invalid = ingest.normalize_chunk(chunk, PRODUCT)
+
+    assert invalid == 1
+    assert list(rows.columns) == ["LATITUD", "LONGITUD", PRODUCT]
+    assert rows["LATITUD"].tolist() == [-12.05, -13.5]
+    assert rows["LONGITUD"].tolist() == [-77.04, -71.9]
+    assert rows[PRODUCT].tolist() == ["Cacao", "Café"]
+
+
+def test_normalize_chunk_drops_out_of_range_and_blank_coordinates():
+    chunk = pd.DataFrame({"LATITUD": [91, -12.0, 0, 10, None], "LONGITUD": [0, 181, 0, 20, 5]})
+    rows, invalid = ingest.normalize_chunk(chunk, PRODUCT)
+
+    assert invalid == 4
+    assert rows[["LATITUD", "LONGITUD"]].values.tolist() == [[10, 20]]
+    assert rows[PRODUCT].isna().all()
+
+
+def test_normalize_chunk_requires_coordinates():
+    with pytest.raises(ValueError):
+        ingest.normalize_chunk(pd.DataFrame({"LATITUD": [1.0], "x": [2.0]}), PRODUCT)
+
+
+def test_read_geojson_chunks():
+    collection = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-77.04, -12.05]},
+         "properties": {"Producto": "Cacao"}},
+        {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": []}, "properties": {}},
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-71.9, -13.5, 3400]}},
+    ]}
+    stream = io.BytesIO(json.dumps(collection).encode("utf-8"))
+    chunks = list(ingest.read_geojson_chunks(stream, chunk_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    rows = pd.concat(chunks, ignore_index=True)
+    assert rows.loc[0, ["LATITUD", "LONGITUD", "Producto"]].tolist() == [-12.05, -77.04, "Cacao"]
+    assert rows.loc[1, ["LATITUD", "LONGITUD"]].isna().all()
+    assert rows.loc[2, ["LATITUD", "LONGITUD"]].tolist() == [-13.5, -71.9]
+
+
+def _collect_appends():
+    appended = []
+
+    def append_points(rows, country):
+        appended.append((country, len(rows)))
+        return len(rows), 0
+
+    return appended, append_points
+
+
+def test_ingest_stream_counts():
+    appended, append_points = _collect_appends()
+    csv_text = "LATITUD,LONGITUD\n-12.05,-77.04\n0,0\n-13.5,-71.9\n"
+    stats = ingest.ingest_stream(io.StringIO(csv_text), "csv", "Peru", append_points, PRODUCT, chunk_size=2)
+
+    assert stats == {"country": "Peru", "rows": 3, "invalid": 1, "duplicates": 0, "added": 2}
+    assert appended == [("Peru", 1), ("Peru", 1)]
+
+
+@pytest.mark.parametrize("fmt, data", [
+    ("geojson", b'{"type": "FeatureCollection", "features": [1]}'),
+    ("geojson", b'{"features": [{"geometry": {"type": "Point", "coordinates": [1, 2]}'),
+    ("csv", "LATITUD,LONGITUD\n1,2\n3,4\n\"5,6\n"),
+])
+def test_ingest_stream_malformed_input_reports_partial_stats(fmt, data):
+    _, append_points = _collect_appends()
+    stream = io.BytesIO(data) if isinstance(data, bytes) else io.StringIO(data)
+    with pytest.raises(ingest.IngestError) as excinfo:
+        ingest.ingest_stream(stream, fmt, "Peru", append_points, PRODUCT, chunk_size=1)
+
+    stats = excinfo.value.stats
+    assert stats["rows"] == stats["added"]
+    if fmt == "csv":
+        assert stats["added"] == 2  # Chunks before the bad row were already appended
+
+
+def test_large_geojson_without_ijson_is_rejected(monkeypatch):
+    monkeypatch.setattr(ingest, "ijson", None)
+    monkeypatch.setattr(ingest, "GEOJSON_MAX_BYTES_WITHOUT_IJSON", 64)
+    _, append_points = _collect_appends()
+    small = b'{"features": []}'
+    assert ingest.ingest_stream(io.BytesIO(small), "geojson", "Peru", append_points, PRODUCT)["rows"] == 0
+
+    large = json.dumps({"features": [{"geometry": {"type": "Point", "coordinates": [1, 2]}}] * 5}).encode("utf-8")
+    with pytest.raises(ingest.IngestError, match="ijson"):
+        ingest.ingest_stream(io.BytesIO(large), "geojson", "Peru", append_points, PRODUCT)
+
+
+def test_detect_format():
+    assert ingest.detect_format("farms.geojson") == "geojson"
+    assert ingest.detect_format("farms.JSON") == "geojson"
+    assert ingest.detect_format("farms.csv") == "csv"
+    assert ingest.detect_format("upload", "GeoJSON") == "geojson"
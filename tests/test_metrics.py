@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+import metrics
+
+LIVE_PID, DEAD_PID = 4_000_001, 4_000_002
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_histograms", {})
+    monkeypatch.setattr(metrics, "_cache_stats", {})
+    monkeypatch.setattr(metrics, "_in_flight", {})
+    monkeypatch.setattr(metrics, "_last_flush", 0.0)
+    monkeypatch.setattr(metrics, "_pid_alive", lambda pid: pid in (os.getpid(), LIVE_PID))
+    return tmp_path
+
+
+def write_snapshot(directory, pid, hits, in_flight, seconds=0.2):
+    hist = {"buckets": [0] * len(metrics.BUCKETS), "sum": seconds, "count": 1}
+    hist["buckets"][metrics.BUCKETS.index(0.25)] = 1
+    snapshot = {"histograms": {"ndvi_fetch": hist}, "cache": {"ndvi_png": {"hit": hits, "miss": 1}},
+                "in_flight": {"ndvi": in_flight}}
+    (directory / f"{pid}-1.json").write_text(json.dumps(snapshot), encoding="utf-8")
+
+
+def test_collect_sums_processes_and_archives_dead_ones_once(metrics_dir):
+    write_snapshot(metrics_dir, LIVE_PID, hits=5, in_flight=2)
+    write_snapshot(metrics_dir, DEAD_PID, hits=7, in_flight=3)
+    metrics.cache_hit("ndvi_png")
+    metrics.observe("ndvi_fetch", 0.02)
+
+    first = metrics._collect()
+    assert first["cache"]["ndvi_png"] == {"hit": 5 + 7 + 1, "miss": 2}
+    assert first["histograms"]["ndvi_fetch"]["count"] == 3
+    assert first["in_flight"] == {"ndvi": 2}  # The dead worker's gauge is dropped
+
+    assert not (metrics_dir / f"{DEAD_PID}-1.json").exists()
+    archive = json.loads((metrics_dir / "archive.json").read_text(encoding="utf-8"))
+    assert archive["cache"]["ndvi_png"] == {"hit": 7, "miss": 1}
+    assert archive["in_flight"] == {}
+
+    # Collecting again (from any worker) neither re-archives nor double counts
+    assert metrics._collect() == first
+    assert json.loads((metrics_dir / "archive.json").read_text(encoding="utf-8")) == archive
+
+
+def test_counters_never_go_backwards_when_a_worker_exits(metrics_dir, monkeypatch):
+    write_snapshot(metrics_dir, LIVE_PID, hits=5, in_flight=1)
+    before = metrics._collect()
+
+    monkeypatch.setattr(metrics, "_pid_alive", lambda pid: pid == os.getpid())
+    after = metrics._collect()
+    assert after["cache"] == before["cache"]
+    assert after["histograms"] == before["histograms"]
+    assert after["in_flight"] == {}
+
+
+def test_unreadable_snapshots_are_skipped(metrics_dir):
+    (metrics_dir / f"{DEAD_PID}-1.json").write_text("{not json", encoding="utf-8")
+    metrics.cache_miss("ndvi_png")
+
+    assert metrics._collect()["cache"] == {"ndvi_png": {"hit": 0, "miss": 1}}
+    assert (metrics_dir / f"{DEAD_PID}-1.json").exists()
+
+
+def test_render_prometheus_reports_the_total(metrics_dir):
+    write_snapshot(metrics_dir, DEAD_PID, hits=7, in_flight=3)
+    metrics.cache_hit("ndvi_png")
+
+    text = metrics.render_prometheus()
+    assert 'ndvi_cache_requests_total{cache="ndvi_png",result="hit"} 8' in text
+    assert 'ndvi_stage_seconds_bucket{stage="ndvi_fetch",le="+Inf"} 1' in text
+    assert 'ndvi_jobs_in_flight{job="ndvi"}' not in text
+
+
+def test_reset_after_fork_starts_a_new_snapshot(metrics_dir, monkeypatch):
+    monkeypatch.setattr(metrics, "_started", metrics._started)
+    monkeypatch.setattr(metrics, "_lock", metrics._lock)
+    metrics.cache_hit("ndvi_png")
+    metrics.flush()
+    parent_path = metrics._snapshot_path()
+
+    metrics._reset_after_fork()
+    assert metrics._snapshot() == {"histograms": {}, "cache": {}, "in_flight": {}}
+    assert metrics._snapshot_path() != parent_path
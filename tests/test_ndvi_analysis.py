@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+import ndvi_analysis
+
+
+# Field-like raster: smooth gradient plus blotches and noise, so edges,
+# Laplacian response and thresholds all vary across the grid
+def make_raster(seed=0, size=96):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    raster = 120 + 60 * np.sin(x / 9.0) * np.cos(y / 13.0) + rng.normal(0, 12, (size, size))
+    for _ in range(6):
+        cy, cx = rng.integers(0, size, 2)
+        raster[(y - cy) ** 2 + (x - cx) ** 2 < rng.integers(20, 120)] -= 70
+    return np.clip(raster, 0, 255).astype(np.uint8)
+
+
+SWEEP_GRID = {
+    "canny_low": [30, 50],
+    "canny_high": [100, 150],
+    "edge_weight": [0.5, 0.7],
+    "laplacian_weight": [0.3, 0.6],
+    "pixel_threshold": [40, 100, 180],
+    "moderate_cutoff": [5, 10],
+    "diseased_cutoff": [30],
+}
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_sweep_matches_detect_pests(seed):
+    raster = make_raster(seed)
+    results = ndvi_analysis.sweep_pest_params(raster, SWEEP_GRID)
+    assert len(results) == 2 * 2 * 2 * 2 * 3 * 2
+
+    for result in results:
+        params = ndvi_analysis.analysis_params(
+            {name: result[name] for name in SWEEP_GRID})
+        _, density = ndvi_analysis.detect_pests(raster, params)
+        expected = ndvi_analysis.pest_summary(0, 0, density, params)
+        assert result["diseased_area"] == expected["diseased_area"], result
+        assert result["status"] == expected["status"], result
+
+
+def test_sweep_rejects_raster_params_and_unknown_names():
+    raster = make_raster()
+    with pytest.raises(ValueError):
+        ndvi_analysis.sweep_pest_params(raster, {"scale": [10, 20]})
+    with pytest.raises(ValueError):
+        ndvi_analysis.sweep_pest_params(raster, {"not_a_param": [1]})
+    with pytest.raises(ValueError):
+        ndvi_analysis.sweep_pest_params(raster, {"pixel_threshold": []})
+
+
+def test_sweep_rejects_non_object_base_params():
+    with pytest.raises(ValueError):
+        ndvi_analysis.sweep_pest_params(make_raster(), {}, base_params=[1, 2])
+
+
+def test_analysis_params_coercion():
+    params = ndvi_analysis.analysis_params({"pixel_threshold": "80", "scale": "20", "unrelated": "x"})
+    assert params["pixel_threshold"] == 80 and isinstance(params["pixel_threshold"], int)
+    assert params["scale"] == 20.0
+    assert ndvi_analysis.analysis_params({"pixel_threshold": 80.0})["pixel_threshold"] == 80
+
+
+@pytest.mark.parametrize("overrides", [
+    {"pixel_threshold": 1.5},
+    {"pixel_threshold": "1.5"},
+    {"edge_weight": "nan"},
+    {"buffer": -5},
+    {"canny_low": 200, "canny_high": 100},
+    {"moderate_cutoff": 40, "diseased_cutoff": 30},
+])
+def test_analysis_params_rejects_invalid_values(overrides):
+    with pytest.raises(ValueError):
+        ndvi_analysis.analysis_params(overrides)
+
+
+def test_params_label_lists_only_overrides():
+    assert ndvi_analysis.params_label(ndvi_analysis.analysis_params()) == "{}"
+    label = ndvi_analysis.params_label(ndvi_analysis.analysis_params({"pixel_threshold": 80}))
+    assert label == '{"pixel_threshold": 80}'
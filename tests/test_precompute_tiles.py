@@ -0,0 +1,71 @@
+import importlib
+import sys
+import types
+
+import numpy as np
+import pytest
+
+import ndvi_analysis
+from test_ndvi_analysis import make_raster
+
+
+# precompute_tiles imports ap, which loads the dataset and Earth Engine at import;
+# the raster helpers tested here don't touch it
+@pytest.fixture
+def tiles(monkeypatch):
+    pytest.importorskip("ee")
+    monkeypatch.setitem(sys.modules, "ap", types.ModuleType("ap"))
+    monkeypatch.delitem(sys.modules, "precompute_tiles", raising=False)
+    return importlib.import_module("precompute_tiles")
+
+
+# Reference: loop over blocks, density over the valid pixels inside the raster
+def reference_density(raster, valid, params, block):
+    detection, _ = ndvi_analysis.detect_pests(raster, params)
+    flagged = (detection > params["pixel_threshold"]) & valid
+    rows, cols = -(-raster.shape[0] // block), -(-raster.shape[1] // block)
+    expected = np.zeros((rows, cols))
+    for i in range(rows):
+        for j in range(cols):
+            cells = np.s_[i * block:(i + 1) * block, j * block:(j + 1) * block]
+            if valid[cells].any():
+                expected[i, j] = flagged[cells].sum() / valid[cells].sum() * 100
+    return expected
+
+
+@pytest.mark.parametrize("pixel_threshold", [40, 100])
+def test_pest_density_raster_partial_blocks_and_mask(tiles, pixel_threshold):
+    raster = make_raster(size=96)[:45, :70]  # Neither side a multiple of PEST_BLOCK
+    valid = raster > 60
+    valid[:tiles.PEST_BLOCK, :tiles.PEST_BLOCK] = False  # One block with no valid pixels
+    params = ndvi_analysis.analysis_params({"pixel_threshold": pixel_threshold})
+
+    density = tiles.pest_density_raster(raster, valid, params)
+    assert density.shape == (3, 5)
+    assert density[0, 0] == 0
+    np.testing.assert_allclose(density, reference_density(raster, valid, params, tiles.PEST_BLOCK), rtol=1e-6)
+
+
+def test_pest_density_raster_defaults_to_detect_pests_threshold(tiles):
+    raster = make_raster(seed=1)[:40, :40]
+    params = ndvi_analysis.DEFAULT_ANALYSIS_PARAMS
+    expected = reference_density(raster, np.ones(raster.shape, dtype=bool), params, tiles.PEST_BLOCK)
+    np.testing.assert_allclose(tiles.pest_density_raster(raster), expected, rtol=1e-6)
+
+
+def test_pest_extent_and_sampling_of_the_partial_last_block(tiles):
+    block = tiles.PEST_BLOCK
+    shape = (2 * block + block // 2, 3 * block + block // 4)  # 2.5 x 3.25 blocks
+    extent = tiles.pest_extent(shape)
+    assert extent == (2.5, 3.25)
+
+    grid_shape = (3, 4)
+    fy = np.array([0.0, 0.39, 0.41, 0.79, 0.81, 0.999])
+    fx = np.array([0.0, 0.3, 0.31, 0.92, 0.93, 0.999])
+    rows, cols = tiles.sample_indices(grid_shape, fy, fx, extent)
+    assert rows[:, 0].tolist() == [0, 0, 1, 1, 2, 2]
+    assert cols[0].tolist() == [0, 0, 1, 2, 3, 3]
+
+    # Without an extent the grid is stretched over the whole bbox instead
+    rows, cols = tiles.sample_indices(grid_shape, fy, fx)
+    assert rows[:, 0].tolist() == [0, 1, 1, 2, 2, 2]
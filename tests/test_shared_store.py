@@ -0,0 +1,110 @@
+import os
+import struct
+import threading
+
+import numpy as np
+import pandas as pd
+
+from shared_store import PointStore, SlotCache, _SLOT_HEADER, publish_points
+
+
+def test_put_get_roundtrip(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=8, slot_size=1024)
+    assert cache.get(("ndvi_png", 1.5, 2.5)) is None
+    assert cache.put(("ndvi_png", 1.5, 2.5), b"png bytes")
+    assert cache.get(("ndvi_png", 1.5, 2.5)) == b"png bytes"
+    assert cache.get(("ndvi_png", 1.5, 9.9)) is None
+
+
+def test_json_roundtrip(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=8, slot_size=1024)
+    cache.put_json(("pest", 1.0, 2.0), {"diseased_area": 12.5, "status": "Moderate"})
+    assert cache.get_json(("pest", 1.0, 2.0)) == {"diseased_area": 12.5, "status": "Moderate"}
+
+
+def test_oversize_value_is_rejected(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=8, slot_size=1024)
+    assert not cache.put("big", b"x" * cache.max_value_size + b"x")
+    assert cache.get("big") is None
+    assert cache.put("fits", b"x" * cache.max_value_size)
+    assert cache.get("fits") == b"x" * cache.max_value_size
+
+
+def test_reopen_keeps_entries_and_layout(tmp_path):
+    path = str(tmp_path / "cache.bin")
+    SlotCache(path, slots=8, slot_size=1024).put("key", b"value")
+
+    # Another process opening with different settings uses the file's layout
+    reopened = SlotCache(path, slots=64, slot_size=4096)
+    assert (reopened.slots, reopened.slot_size) == (8, 1024)
+    assert reopened.get("key") == b"value"
+
+
+def test_equal_numeric_keys_share_a_slot(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=8, slot_size=1024)
+    cache.put(("ndvi_raw", -12.05, -77.04, "2021-01-01", "2021-12-31", 1000, 10), b"raster")
+    assert cache.get(("ndvi_raw", np.float64(-12.05), -77.04, "2021-01-01", "2021-12-31", 1000.0, 10.0)) == b"raster"
+
+
+def test_slot_being_written_reads_as_miss(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=8, slot_size=1024)
+    cache.put("key", b"value")
+    offset = cache._offset(cache._digest("key"))
+
+    seq = struct.unpack_from("<Q", cache.map, offset)[0]
+    struct.pack_into("<Q", cache.map, offset, seq + 1)  # Odd: writer in progress
+    assert cache.get("key") is None
+
+    struct.pack_into("<Q", cache.map, offset, seq)
+    assert cache.get("key") == b"value"
+
+
+def test_corrupted_value_reads_as_miss(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=8, slot_size=1024)
+    cache.put("key", b"value")
+    offset = cache._offset(cache._digest("key"))
+    start = offset + _SLOT_HEADER.size
+    cache.map[start:start + 1] = b"V"
+    assert cache.get("key") is None
+
+
+def test_concurrent_publishes_leave_one_complete_store(tmp_path):
+    directory = str(tmp_path / "points")
+    frames = [pd.DataFrame({"country": ["Peru"] * n + ["Chile"], "crop": ["Cacao"] * (n + 1)})
+              for n in range(1, 9)]
+    errors = []
+
+    def publish(df):
+        try:
+            publish_points(df, "crop", directory)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=publish, args=(df,)) for df in frames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == ["points", "points.lock"]
+    store = PointStore(directory)
+    assert store.country_counts()["Chile"] == 1
+    assert len(store.product_code) == store.index["rows"]
+
+
+def test_threads_writing_one_slot_never_corrupt_it(tmp_path):
+    cache = SlotCache(str(tmp_path / "cache.bin"), slots=1, slot_size=64 * 1024)
+    values = [bytes([n]) * (cache.max_value_size - n) for n in range(8)]
+
+    def write(value):
+        for _ in range(50):
+            cache.put("key", value)
+
+    threads = [threading.Thread(target=write, args=(value,)) for value in values]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.get("key") in values
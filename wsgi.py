@@ -0,0 +1,11 @@
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+import ap
+
+
+# WSGI factory (gunicorn "wsgi:create_app()"); importing ap loads the
+# merged CSV dataset once, so with preload_app it is shared copy-on-write
+def create_app():
+    return ap.app
+
+
+app = create_app()